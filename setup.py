@@ -165,7 +165,8 @@ setup(
     # MANIFEST.in as well.
     include_package_data=True,
     package_data={  # Optional
-       'sidesplitter': ['sidesplitter_logo.png', 'protocols.conf'],
+       'sidesplitter': ['sidesplitter_logo.png', 'protocols.conf',
+                        'fftw_wisdom.c'],
     },
 
     # Although 'package_data' is the preferred approach, in some case you may
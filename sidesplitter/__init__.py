@@ -25,11 +25,18 @@
 # **************************************************************************
 
 import os
+import sys
+import platform
 
 import pwem
 from pyworkflow.utils import Environ
 
-from .constants import SIDESPLITTER_HOME, V1_2
+from .constants import (SIDESPLITTER_HOME, V1_2, SIDESPLITTER_CACHE,
+                        SIDESPLITTER_CACHE_SIZE, DEFAULT_CACHE_DIR,
+                        SIDESPLITTER_BUILD, BUILD_DEFAULT, BUILD_FLAGS,
+                        SIDESPLITTER_WISDOM, DEFAULT_WISDOM_DIR,
+                        SIDESPLITTER_SERVICE, DEFAULT_SERVICE_SOCKET,
+                        SIDESPLITTER_SHELLS, DEFAULT_SHELLS_DIR)
 
 __version__ = '3.0.12'
 _logo = "sidesplitter_logo.png"
@@ -45,6 +52,12 @@ class Plugin(pwem.Plugin):
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(SIDESPLITTER_HOME, 'sidesplitter-1.2')
+        cls._defineVar(SIDESPLITTER_CACHE, DEFAULT_CACHE_DIR)
+        cls._defineVar(SIDESPLITTER_CACHE_SIZE, 50)  # GB
+        cls._defineVar(SIDESPLITTER_BUILD, BUILD_DEFAULT)
+        cls._defineVar(SIDESPLITTER_WISDOM, DEFAULT_WISDOM_DIR)
+        cls._defineVar(SIDESPLITTER_SHELLS, DEFAULT_SHELLS_DIR)
+        cls._defineVar(SIDESPLITTER_SERVICE, DEFAULT_SERVICE_SOCKET)
 
     @classmethod
     def getEnviron(cls):
@@ -59,15 +72,65 @@ class Plugin(pwem.Plugin):
         cmd = cls.getHome('sidesplitter')
         return str(cmd)
 
+    @classmethod
+    def getNativeProgram(cls):
+        """ Return the command running the native Python engine. """
+        return '%s -m sidesplitter.engine' % sys.executable
+
+    @classmethod
+    def getServiceAddress(cls):
+        """ Return the socket of the native engine service. """
+        return os.path.abspath(
+            os.path.expanduser(cls.getVar(SIDESPLITTER_SERVICE)))
+
+    @classmethod
+    def getCache(cls):
+        """ Return the cache of converted inputs. Relative cache roots
+        are resolved inside the project directory.
+        """
+        from .cache import ConversionCache
+        root = os.path.abspath(cls.getVar(SIDESPLITTER_CACHE))
+        maxBytes = float(cls.getVar(SIDESPLITTER_CACHE_SIZE)) * 1024 ** 3
+        return ConversionCache(root, int(maxBytes))
+
+    @classmethod
+    def getWisdomFile(cls, box, threads):
+        """ Return the FFTW wisdom file of the binary for a box size
+        and number of threads on this host. Relative wisdom folders
+        are resolved inside the project directory.
+        """
+        wisdomDir = os.path.abspath(cls.getVar(SIDESPLITTER_WISDOM))
+        os.makedirs(wisdomDir, exist_ok=True)
+        return os.path.join(wisdomDir, 'wisdom_%s_%d_%d.fftw'
+                            % (platform.node(), box, threads))
+
+    @classmethod
+    def getShellsDir(cls):
+        """ Return the folder where the native engine saves the Fourier
+        shells of each box size. Relative folders are resolved inside
+        the project directory.
+        """
+        return os.path.abspath(cls.getVar(SIDESPLITTER_SHELLS))
+
     @classmethod
     def defineBinaries(cls, env):
         ver = "1.2"
         url = 'https://github.com/StructuralBiology-ICLMedicine/SIDESPLITTER.git'
+        build = cls.getVar(SIDESPLITTER_BUILD)
+        if build not in BUILD_FLAGS:
+            print("Unknown %s '%s', using '%s'. Valid values are: %s"
+                  % (SIDESPLITTER_BUILD, build, BUILD_DEFAULT,
+                     ', '.join(BUILD_FLAGS)))
+            build = BUILD_DEFAULT
+        # Keeps the FFTW wisdom between runs, see fftw_wisdom.c
+        wisdomSrc = os.path.join(os.path.dirname(__file__), 'fftw_wisdom.c')
         installCmd = [
             f'cd .. && rmdir sidesplitter-{ver} &&',
             f'git clone {url} sidesplitter-{ver} &&',
             f'cd sidesplitter-{ver} &&',
-            'gcc -O3 *.c -lm -pthread -lfftw3 -lfftw3_threads -std=c99 -o sidesplitter'
+            f'gcc {BUILD_FLAGS[build]} *.c {wisdomSrc} '
+            '-Wl,--wrap=fftw_init_threads -Wl,--wrap=fftw_cleanup '
+            '-lm -pthread -lfftw3 -lfftw3_threads -std=c99 -o sidesplitter'
         ]
 
         commands = [(" ".join(installCmd), 'sidesplitter')]
@@ -0,0 +1,300 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark of the SIDESPLITTER pipeline on synthetic half-maps.
+
+For each box size a pair of half-maps with a known SNR and a mask are
+generated, and the stages of the local filter protocol (input
+conversion, filtering and output registration, with the statistics
+and FSC of the filtered maps) are run in separate
+processes, recording wall time, CPU time and peak RSS. Results are
+saved as JSON so that different plugin versions can be compared. No
+dataset or other plugin is needed:
+
+    python -m sidesplitter.benchmark --sizes 64 128 256 -o bench.json
+    python -m sidesplitter.benchmark --compare old.json bench.json
+
+The time of the Fourier transforms of each box size, compared with the
+fast size the protocol pads it to, can be measured with:
+
+    python -m sidesplitter.benchmark --fft-sizes 440 450 462 480
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+import mrcfile
+from scipy import fft
+
+from . import __version__
+from .constants import ENGINE_BINARY, ENGINE_NATIVE
+from .convert import (stageHalfMap, prepareMask, readVolumeStats,
+                      combineHalves)
+from .fsc import computeFsc
+from .resources import measure
+from .boxes import getFastSize
+
+
+def makeHalfMaps(n, snr=1.0, seed=0):
+    """ Return (signal, half1, half2, mask) for a n^3 box. The signal is
+    a sum of Gaussian blobs with unit variance inside the mask and each
+    half-map adds independent white noise of variance 1 / snr.
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[:n, :n, :n]
+    center = n / 2.0
+    radius = n / 3.0
+    signal = np.zeros((n, n, n), dtype=np.float32)
+
+    for _ in range(max(10, n // 2)):
+        c = rng.uniform(center - radius / 1.5, center + radius / 1.5, 3)
+        sigma = rng.uniform(1, 3)
+        signal += np.exp(-((z - c[0]) ** 2 + (y - c[1]) ** 2 +
+                           (x - c[2]) ** 2) / (2 * sigma ** 2))
+
+    dist = np.sqrt((z - center) ** 2 + (y - center) ** 2 + (x - center) ** 2)
+    mask = np.clip((radius + 3 - dist) / 6.0, 0, 1).astype(np.float32)
+    signal *= mask
+    signal /= signal[mask > 0.5].std()
+
+    noise = 1 / np.sqrt(snr)
+    half1 = signal + rng.normal(0, noise, signal.shape).astype(np.float32)
+    half2 = signal + rng.normal(0, noise, signal.shape).astype(np.float32)
+
+    return signal, half1, half2, mask
+
+
+def writeInputs(workDir, n, snr=1.0, mode=2):
+    """ Write the synthetic maps of a n^3 box into workDir. Inputs are
+    written with the given MRC mode, e.g. 12 (float16) to benchmark
+    the slab-wise conversion instead of linking.
+    """
+    signal, half1, half2, mask = makeHalfMaps(n, snr)
+    dtype = {2: np.float32, 12: np.float16}[mode]
+    for name, data in [('signal', signal), ('input_half1', half1),
+                       ('input_half2', half2), ('input_mask', mask)]:
+        with mrcfile.new(os.path.join(workDir, name + '.mrc'),
+                         data.astype(dtype), overwrite=True) as mrc:
+            mrc.voxel_size = 1.0
+
+
+def runConvert(workDir):
+    """ Same work as the conversion steps of the protocol. """
+    for half in [1, 2]:
+        stageHalfMap(os.path.join(workDir, 'input_half%d.mrc' % half),
+                     os.path.join(workDir, 'half%d_unfil.mrc' % half))
+    prepareMask(os.path.join(workDir, 'input_mask.mrc'),
+                os.path.join(workDir, 'mask.mrc'))
+
+
+def runFilter(workDir, engine=ENGINE_NATIVE, threads=1, spectrum=False):
+    """ Run the filter program as the protocol does. """
+    if engine == ENGINE_BINARY:
+        from . import Plugin
+        cmd = [Plugin.getProgram()]
+    else:
+        cmd = [sys.executable, '-m', 'sidesplitter.engine']
+    cmd += ['--v1', 'half1_unfil.mrc', '--v2', 'half2_unfil.mrc',
+            '--mask', 'mask.mrc']
+    if spectrum:
+        cmd.append('--spectrum')
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    subprocess.run(cmd, cwd=workDir, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+
+def runOutput(workDir, combine=False, bfactor=-50):
+    """ Same work as the steps that register the outputs: statistics
+    and previews of the filtered maps, the masked and unmasked FSC of
+    the input and filtered half-maps and, if combine is set, the
+    combined map sharpened with bfactor.
+    """
+    def path(name):
+        return os.path.join(workDir, name)
+
+    outputFns = [path('half%d_unfil_sidesplitter.mrc' % half)
+                 for half in [1, 2]]
+    if combine:
+        combineHalves(outputFns[0], outputFns[1],
+                      path('combined_sidesplitter.mrc'), bfactor)
+        outputFns.append(path('combined_sidesplitter.mrc'))
+    for fn in outputFns:
+        readVolumeStats(fn, os.path.splitext(fn)[0] + '_preview.mrc')
+
+    computeFsc(path('half1_unfil.mrc'), path('half2_unfil.mrc'),
+               path('mask.mrc'))
+    computeFsc(outputFns[0], outputFns[1], path('mask.mrc'))
+
+
+def getCorrelation(workDir):
+    """ Correlation of the filtered half-map 1 with the true signal. """
+    signal = mrcfile.read(os.path.join(workDir, 'signal.mrc'))
+    filtered = mrcfile.read(os.path.join(workDir,
+                                         'half1_unfil_sidesplitter.mrc'))
+    return float(np.corrcoef(signal.ravel(), filtered.ravel())[0, 1])
+
+
+def runBenchmark(sizes, engine=ENGINE_NATIVE, threads=1, snr=1.0, mode=2,
+                 outFn=None, combine=False):
+    """ Benchmark all stages for each box size and return the results,
+    optionally saving them to outFn as JSON. If combine is set, the
+    output stage also creates the combined map.
+    """
+    results = []
+    for n in sizes:
+        workDir = tempfile.mkdtemp(prefix='sidesplitter_bench_')
+        try:
+            writeInputs(workDir, n, snr, mode)
+            for stage, func, kwargs in [
+                    ('convert', runConvert, {}),
+                    ('filter', runFilter, {'engine': engine,
+                                           'threads': threads}),
+                    ('output', runOutput, {'combine': combine})]:
+                row = measure(func, workDir, **kwargs)
+                row.update(box=n, stage=stage)
+                results.append(row)
+            results[-2]['cc'] = getCorrelation(workDir)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        'version': __version__,
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'engine': engine,
+        'threads': threads,
+        'snr': snr,
+        'mode': mode,
+        'combine': combine,
+        'results': results
+    }
+    if outFn:
+        with open(outFn, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def timeFFT(n, threads=1, repeats=3):
+    """ Best time of a forward and inverse real FFT of a n^3 box. """
+    data = np.random.default_rng(0).standard_normal((n, n, n),
+                                                    dtype=np.float32)
+    best = np.inf
+    # The first transform also plans, it is not timed
+    for i in range(repeats + 1):
+        start = time.perf_counter()
+        fft.irfftn(fft.rfftn(data, workers=threads), s=data.shape,
+                   workers=threads)
+        if i:
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def runFFTSizes(sizes, threads=1, repeats=3):
+    """ Time the FFTs of each box size and of the fast size it would
+    be padded to by the protocol.
+    """
+    rows = []
+    for n in sizes:
+        fast = getFastSize(n)
+        t = timeFFT(n, threads, repeats)
+        tFast = t if fast == n else timeFFT(fast, threads, repeats)
+        rows.append({'box': n, 'fast': fast, 'time': t, 'fastTime': tFast})
+    return rows
+
+
+def compare(oldReport, newReport):
+    """ Return the new / old ratios of wall time and peak memory for
+    every (box, stage) present in both reports.
+    """
+    old = {(r['box'], r['stage']): r for r in oldReport['results']}
+    rows = []
+    for r in newReport['results']:
+        ref = old.get((r['box'], r['stage']))
+        if ref:
+            rows.append({'box': r['box'], 'stage': r['stage'],
+                         'wall': r['wall'] / max(ref['wall'], 1e-9),
+                         'peak': r['peak'] / float(max(ref['peak'], 1))})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='sidesplitter.benchmark',
+        description='Benchmark the SIDESPLITTER pipeline on synthetic maps.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128],
+                        help='Box sizes to benchmark.')
+    parser.add_argument('--engine', choices=['binary', 'native'],
+                        default='native')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--snr', type=float, default=1.0)
+    parser.add_argument('--mode', type=int, choices=[2, 12], default=2,
+                        help='MRC mode of the synthetic inputs.')
+    parser.add_argument('--combine', action='store_true',
+                        help='Also create the combined map in the output '
+                             'stage.')
+    parser.add_argument('-o', '--output', help='Output JSON file.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two JSON results instead.')
+    parser.add_argument('--fft-sizes', type=int, nargs='+',
+                        help='Only time the FFTs of these box sizes and '
+                             'of the fast sizes they are padded to.')
+    args = parser.parse_args(argv)
+
+    if args.fft_sizes:
+        for row in runFFTSizes(args.fft_sizes, args.threads):
+            print('%(box)5d %(time)8.3f s   padded to %(fast)5d '
+                  '%(fastTime)8.3f s' % row)
+        return
+
+    if args.compare:
+        reports = []
+        for fn in args.compare:
+            with open(fn) as f:
+                reports.append(json.load(f))
+        for row in compare(*reports):
+            print('%(box)5d %(stage)-8s wall x%(wall)0.2f '
+                  'peak x%(peak)0.2f' % row)
+        return
+
+    engine = ENGINE_BINARY if args.engine == 'binary' else ENGINE_NATIVE
+    report = runBenchmark(args.sizes, engine, args.threads, args.snr,
+                          args.mode, args.output, args.combine)
+    for row in report['results']:
+        print('%5d %-8s wall %8.2f s  cpu %8.2f s  peak %8.1f MB' %
+              (row['box'], row['stage'], row['wall'], row['cpu'],
+               row['peak'] / 1024. ** 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Box geometry helpers: FFT-friendly sizes, the bounding box of a mask
+and slab-wise cropping, pasting and compositing of MRC volumes.
+
+Boxes are lists of (start, end) ranges in (z, y, x) order, as the
+arrays read by mrcfile.
+"""
+
+import numpy as np
+import mrcfile
+
+from .convert import SLAB_BYTES, iterSlabs
+from .engine import asMask, unlinkOutput
+
+
+# Prime factors of the box sizes that FFT libraries handle fastest
+FFT_FACTORS = (2, 3, 5, 7)
+
+
+def isFastSize(n, factors=FFT_FACTORS):
+    """ Return True if n is a product of the given factors. """
+    for f in factors:
+        while n > 1 and n % f == 0:
+            n //= f
+    return n == 1
+
+
+def getFastSize(n, factors=FFT_FACTORS):
+    """ Return the smallest even size >= n that is a product of
+    the given factors.
+    """
+    n += n % 2
+    while not isFastSize(n, factors):
+        n += 2
+    return n
+
+
+def getMaskBox(maskFn, margin=0, slabBytes=SLAB_BYTES):
+    """ Return the bounding box of the non-zero voxels of a mask,
+    grown by margin voxels on each side and clipped to the volume,
+    or None if the mask is empty.
+    """
+    with mrcfile.mmap(maskFn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        shape = data.shape
+        zs, ys, xs = [], [], []
+        for start, end in iterSlabs(shape[0], shape[1] * shape[2],
+                                    slabBytes):
+            inside = data[start:end] > 0
+            if not inside.any():
+                continue
+            z = np.flatnonzero(inside.any(axis=(1, 2)))
+            y = np.flatnonzero(inside.any(axis=(0, 2)))
+            x = np.flatnonzero(inside.any(axis=(0, 1)))
+            zs.extend([start + z[0], start + z[-1]])
+            ys.extend([y[0], y[-1]])
+            xs.extend([x[0], x[-1]])
+
+    if not zs:
+        return None
+
+    return [(int(max(min(v) - margin, 0)), int(min(max(v) + 1 + margin, n)))
+            for v, n in zip([zs, ys, xs], shape)]
+
+
+def fitBox(box, shape, cubic=False):
+    """ Grow box around its center so that each side has a fast FFT
+    size, keeping it inside shape. If cubic, all sides get the size
+    of the largest one.
+    """
+    sizes = [end - start for start, end in box]
+    if cubic:
+        sizes = [max(sizes)] * 3
+    fitted = []
+    for (start, end), size, n in zip(box, sizes, shape):
+        size = min(getFastSize(size), n)
+        start = min(max((start + end - size) // 2, 0), n - size)
+        fitted.append((start, start + size))
+    return fitted
+
+
+def isFullBox(box, shape):
+    return all(b == (0, n) for b, n in zip(box, shape))
+
+
+def getPadShape(box, cubic=False):
+    """ Return the shape with fast FFT sizes where box fits. """
+    sizes = [end - start for start, end in box]
+    if cubic:
+        sizes = [max(sizes)] * 3
+    return tuple(getFastSize(size) for size in sizes)
+
+
+def _getOffsets(box, shape):
+    """ Position of box when centered in a volume of shape. """
+    return [(n - (end - start)) // 2 for (start, end), n in zip(box, shape)]
+
+
+def cropVolume(inFn, outFn, box, padShape=None, slabBytes=SLAB_BYTES):
+    """ Write the box region of a MRC volume to outFn, keeping its
+    mode and voxel size. If padShape is given, the region is centered
+    in a volume of that shape, filled with zeros.
+    """
+    (z0, z1), (y0, y1), (x0, x1) = box
+    shape = tuple(padShape or (z1 - z0, y1 - y0, x1 - x0))
+    oz, oy, ox = _getOffsets(box, shape)
+    with mrcfile.mmap(inFn, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        unlinkOutput(outFn)
+        with mrcfile.new_mmap(outFn, shape,
+                              mrc_mode=int(mrcIn.header.mode),
+                              overwrite=True, fill=0) as mrcOut:
+            sliceBytes = (y1 - y0) * (x1 - x0) * data.itemsize
+            for start, end in iterSlabs(z1 - z0, sliceBytes, slabBytes):
+                mrcOut.data[oz + start:oz + end,
+                            oy:oy + y1 - y0, ox:ox + x1 - x0] = \
+                    data[z0 + start:z0 + end, y0:y1, x0:x1]
+            mrcOut.voxel_size = mrcIn.voxel_size
+    return outFn
+
+
+def _taper(start, end, n, width):
+    """ Cosine ramp over width voxels at the ends of [start, end)
+    that are not at the border of the volume.
+    """
+    w = np.ones(end - start, dtype=np.float32)
+    width = min(width, (end - start) // 2)
+    if width > 0:
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(width) + 0.5) / width)
+        if start > 0:
+            w[:width] = ramp
+        if end < n:
+            w[-width:] = ramp[::-1]
+    return w
+
+
+def pasteVolume(cropFn, outFn, shape, box, taper=0, slabBytes=SLAB_BYTES):
+    """ Write the cropped volume cropFn back into the box region of a
+    new float32 volume of the given shape, filled with zeros. The
+    pasted values fade out over taper voxels towards the inner faces
+    of the box. If cropFn was padded by cropVolume, only its central
+    region is used.
+    """
+    (z0, z1), (y0, y1), (x0, x1) = box
+    wz, wy, wx = [_taper(s, e, n, taper) for (s, e), n in zip(box, shape)]
+    with mrcfile.mmap(cropFn, mode='r', permissive=True) as mrcIn:
+        oz, oy, ox = _getOffsets(box, mrcIn.data.shape)
+        data = mrcIn.data[oz:oz + z1 - z0, oy:oy + y1 - y0, ox:ox + x1 - x0]
+        unlinkOutput(outFn)
+        with mrcfile.new_mmap(outFn, tuple(shape), mrc_mode=2,
+                              overwrite=True, fill=0) as mrcOut:
+            sliceBytes = (y1 - y0) * (x1 - x0) * 4
+            for start, end in iterSlabs(z1 - z0, sliceBytes, slabBytes):
+                slab = data[start:end].astype(np.float32)
+                slab *= wz[start:end, None, None]
+                slab *= wy[None, :, None] * wx[None, None, :]
+                mrcOut.data[z0 + start:z0 + end, y0:y1, x0:x1] = slab
+            mrcOut.voxel_size = mrcIn.voxel_size
+    return outFn
+
+
+def compositeVolumes(cropFns, weightFns, outFn, shape, boxes, fade=True,
+                     slabBytes=SLAB_BYTES):
+    """ Write to outFn a new float32 volume of the given shape with
+    the average of the cropped volumes cropFns pasted in their boxes,
+    weighted by weightFns (soft masks cropped like them, possibly
+    int8 compact masks). Where the weights add up to less than one,
+    the values fade out to zero with them, as with a single mask.
+    If fade is False (e.g. for local resolution values), the weighted
+    mean is used wherever any weight is positive, and zero elsewhere.
+    """
+    nz, ny, nx = shape
+    mrcs = [(mrcfile.mmap(fn, mode='r', permissive=True),
+             mrcfile.mmap(wFn, mode='r', permissive=True))
+            for fn, wFn in zip(cropFns, weightFns)]
+    try:
+        unlinkOutput(outFn)
+        with mrcfile.new_mmap(outFn, tuple(shape), mrc_mode=2,
+                              overwrite=True, fill=0) as mrcOut:
+            for start, end in iterSlabs(nz, ny * nx * 8, slabBytes):
+                total = np.zeros((end - start, ny, nx), dtype=np.float32)
+                weights = np.zeros_like(total)
+                for (mrcIn, mrcWeight), box in zip(mrcs, boxes):
+                    (z0, z1), (y0, y1), (x0, x1) = box
+                    first, last = max(start, z0), min(end, z1)
+                    if first >= last:
+                        continue
+                    oz, oy, ox = _getOffsets(box, mrcIn.data.shape)
+                    region = (slice(oz + first - z0, oz + last - z0),
+                              slice(oy, oy + y1 - y0),
+                              slice(ox, ox + x1 - x0))
+                    w = asMask(mrcWeight.data[region])
+                    target = (slice(first - start, last - start),
+                              slice(y0, y1), slice(x0, x1))
+                    total[target] += w * mrcIn.data[region]
+                    weights[target] += w
+                if fade:
+                    norm = np.maximum(weights, 1)
+                else:
+                    norm = np.where(weights > 0, weights, 1)
+                mrcOut.data[start:end] = total / norm
+            mrcOut.voxel_size = mrcs[0][0].voxel_size
+    finally:
+        for mrcIn, mrcWeight in mrcs:
+            mrcIn.close()
+            mrcWeight.close()
+    return outFn
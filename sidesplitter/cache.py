@@ -0,0 +1,176 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+from . import __version__
+
+
+def fileStamp(fn):
+    """ Return the real path, size and modification time of fn. """
+    realFn = os.path.realpath(fn)
+    st = os.stat(realFn)
+    return '%s:%d:%d' % (realFn, st.st_size, st.st_mtime_ns)
+
+
+def _makeKey(inputIds, params):
+    h = hashlib.sha256()
+    h.update(__version__.encode())
+    for inputId in inputIds:
+        h.update(inputId.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def makeStampKey(inputFns, **params):
+    """ Build a key like ConversionCache.makeKey from the path, size
+    and modification time of inputFns, without reading them.
+    """
+    return _makeKey([fileStamp(fn) for fn in inputFns], params)
+
+
+class ConversionCache:
+    """ Content-addressed store of converted volumes shared by all
+    SIDESPLITTER runs of a project.
+
+    Entries are keyed by a hash of the input file contents, the
+    conversion parameters and the plugin version. Cached files are
+    hard-linked into the run directories (copied across filesystems),
+    so evicting an entry never breaks a run that already uses it.
+    The least recently used entries are evicted once the total size
+    exceeds maxBytes.
+    """
+    INDEX = 'index.json'
+    LOCK = '.lock'
+    CHUNK = 16 * 1024 * 1024
+
+    def __init__(self, root, maxBytes):
+        self.root = root
+        self.maxBytes = maxBytes
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, *p):
+        return os.path.join(self.root, *p)
+
+    @contextmanager
+    def _lockedIndex(self):
+        """ Load the index under an exclusive lock and save it back. """
+        with open(self._path(self.LOCK), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                with open(self._path(self.INDEX)) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+            index.setdefault('entries', {})
+            index.setdefault('digests', {})
+            yield index
+            tmpFn = self._path(self.INDEX + '.tmp')
+            with open(tmpFn, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmpFn, self._path(self.INDEX))
+
+    def fileDigest(self, fn):
+        """ Return the content hash of fn. Digests are remembered by
+        path, size and modification time to avoid re-reading the file.
+        """
+        realFn = os.path.realpath(fn)
+        stamp = fileStamp(realFn)
+
+        with self._lockedIndex() as index:
+            digest = index['digests'].get(stamp)
+        if digest is not None:
+            return digest
+
+        h = hashlib.blake2b(digest_size=20)
+        with open(realFn, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.CHUNK), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        with self._lockedIndex() as index:
+            index['digests'][stamp] = digest
+        return digest
+
+    def makeKey(self, inputFns, **params):
+        """ Build the cache key for converting inputFns with params. """
+        return _makeKey([self.fileDigest(fn) for fn in inputFns], params)
+
+    def has(self, key):
+        """ Return True if there is an entry for key. """
+        with self._lockedIndex() as index:
+            return (key in index['entries'] and
+                    os.path.exists(self._path(key + '.mrc')))
+
+    def fetch(self, key, outFn):
+        """ Place the cached file for key at outFn.
+        Return False if there is no such entry.
+        """
+        cachedFn = self._path(key + '.mrc')
+        with self._lockedIndex() as index:
+            entry = index['entries'].get(key)
+            if entry is None or not os.path.exists(cachedFn):
+                return False
+            _linkOrCopy(cachedFn, outFn)
+            entry['atime'] = time.time()
+        return True
+
+    def store(self, key, fn):
+        """ Add the converted file fn to the cache under key. """
+        cachedFn = self._path(key + '.mrc')
+        with self._lockedIndex() as index:
+            _linkOrCopy(fn, cachedFn)
+            index['entries'][key] = {'size': os.path.getsize(cachedFn),
+                                     'atime': time.time()}
+            self._evict(index)
+
+    def _evict(self, index):
+        """ Remove least recently used entries above maxBytes. """
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['atime']):
+            if total <= self.maxBytes:
+                break
+            total -= entries.pop(key)['size']
+            cachedFn = self._path(key + '.mrc')
+            if os.path.exists(cachedFn):
+                os.remove(cachedFn)
+
+
+def _linkOrCopy(srcFn, dstFn):
+    """ Hard-link srcFn to dstFn, copying when not possible. """
+    if os.path.lexists(dstFn):
+        os.remove(dstFn)
+    try:
+        os.link(os.path.realpath(srcFn), dstFn)
+    except OSError:
+        shutil.copyfile(srcFn, dstFn)
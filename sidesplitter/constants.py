@@ -29,3 +29,42 @@ SIDESPLITTER_HOME = 'SIDESPLITTER_HOME'
 
 # Supported versions
 V1_2 = '1.2'
+
+# Project-level cache of converted inputs
+SIDESPLITTER_CACHE = 'SIDESPLITTER_CACHE'
+SIDESPLITTER_CACHE_SIZE = 'SIDESPLITTER_CACHE_SIZE'
+DEFAULT_CACHE_DIR = 'Tmp/sidesplitter_cache'
+
+# Filtering engines
+ENGINE_BINARY = 0
+ENGINE_NATIVE = 1
+
+# Preview binning of the local filter protocol
+BIN_NONE = 0
+BIN_2X = 1
+BIN_4X = 2
+BIN_FACTORS = {BIN_NONE: 1, BIN_2X: 2, BIN_4X: 4}
+
+# Build variants of the SIDESPLITTER binary, selected in scipion.conf.
+# Binaries built with -march=native only run on CPUs like the one
+# where they were compiled.
+SIDESPLITTER_BUILD = 'SIDESPLITTER_BUILD'
+BUILD_DEFAULT = 'default'
+BUILD_FLAGS = {
+    BUILD_DEFAULT: '-O3',
+    'native': '-O3 -march=native',
+    'lto': '-O3 -flto',
+    'native-lto': '-O3 -march=native -flto'
+}
+
+# FFTW wisdom files of the SIDESPLITTER binary
+SIDESPLITTER_WISDOM = 'SIDESPLITTER_WISDOM'
+DEFAULT_WISDOM_DIR = 'Tmp/sidesplitter_wisdom'
+
+# Fourier shells saved by the native engine, see sidesplitter.shells
+SIDESPLITTER_SHELLS = 'SIDESPLITTER_SHELLS'
+DEFAULT_SHELLS_DIR = 'Tmp/sidesplitter_shells'
+
+# Socket of the local service running native engine jobs
+SIDESPLITTER_SERVICE = 'SIDESPLITTER_SERVICE'
+DEFAULT_SERVICE_SOCKET = '~/.sidesplitter/service.sock'
@@ -24,26 +24,459 @@
 # *
 # **************************************************************************
 
+import os
+
+import numpy as np
+import mrcfile
+from scipy.signal import resample
+from mrcfile.utils import data_dtype_from_header
+
+from pyworkflow.object import Float, String
 from pwem.emlib.image import ImageHandler
 
+from .engine import MASK_LEVELS, unlinkOutput
+
+
+# Maximum amount of voxel data kept in memory while streaming volumes
+SLAB_BYTES = 256 * 1024 * 1024
+
+# Real-valued MRC modes that can be transcoded slab by slab
+REAL_MODES = (0, 1, 2, 6, 12)
+
+# MRC modes used to store intermediate files
+MODE_INT8 = 0
+MODE_FLOAT32 = 2
+MODE_FLOAT16 = 12
+
+# Staging methods reported by stageHalfMap
+STAGE_LINK = 'link'
+STAGE_SLABS = 'slabs'
+STAGE_CONVERT = 'convert'
+
+# Maximum box size of the previews stored next to the output volumes
+PREVIEW_DIM = 64
+
+# Volume attributes where readVolumeStats results are stored
+STATS_ATTRS = ('min', 'max', 'mean', 'std')
+
 
 def getImageLocation(location):
     return ImageHandler.locationToXmipp(location)
 
 
-def convertMask(img, outFn, newDim=None):
+def splitLocation(location):
+    """ Split a Scipion/Xmipp location string into (index, path).
+    Both the "index@path" prefix and the ":mrc" suffix are removed
+    from the path, index is 1 if not present.
+    """
+    index, path = 1, location
+    if '@' in path:
+        idx, path = path.split('@', 1)
+        index = int(idx)
+    if ':' in path:
+        path = path.rsplit(':', 1)[0]
+
+    return index, path
+
+
+def readMrcHeader(fn):
+    """ Read the header of a MRC file without loading the data.
+    Return None if the file can not be read as MRC.
+    """
+    try:
+        with mrcfile.open(fn, permissive=True, header_only=True) as mrc:
+            h = mrc.header
+            if h is None:
+                return None
+            dtype = data_dtype_from_header(h)
+            return {
+                'dims': (int(h.nx), int(h.ny), int(h.nz)),
+                'mode': int(h.mode),
+                'native': dtype.isnative,
+                'nsymbt': int(h.nsymbt),
+                'axes': (int(h.mapc), int(h.mapr), int(h.maps)),
+                'stack': bool(mrcfile.utils.spacegroup_is_volume_stack(h.ispg)),
+                'voxelSize': float(mrc.voxel_size.x)
+            }
+    except Exception:
+        return None
+
+
+def isMrcCompatible(header, modes=(MODE_FLOAT32,)):
+    """ Return True if the MRC file described by header can be passed
+    to SIDESPLITTER as it is: a single volume of one of the given
+    modes (float32 by default) in the native byte order, standard axis
+    order and no extended header.
+    """
+    return (header is not None and
+            header['mode'] in modes and
+            header['native'] and
+            header['nsymbt'] == 0 and
+            header['axes'] == (1, 2, 3) and
+            not header['stack'])
+
+
+def linkFile(srcFn, dstFn):
+    """ Hard-link srcFn to dstFn, falling back to an absolute symlink
+    when both paths are not on the same filesystem.
+    """
+    unlinkOutput(dstFn)
+    try:
+        os.link(srcFn, dstFn)
+    except OSError:
+        os.symlink(os.path.abspath(srcFn), dstFn)
+
+
+def iterSlabs(nz, sliceBytes, slabBytes=SLAB_BYTES):
+    """ Yield (start, end) Z ranges so that each slab of slices
+    takes at most slabBytes (but at least one slice).
+    """
+    step = max(1, slabBytes // max(sliceBytes, 1))
+    for start in range(0, nz, step):
+        yield start, min(start + step, nz)
+
+
+def convertVolumeSlabs(inFn, outFn, slabBytes=SLAB_BYTES,
+                       mode=MODE_FLOAT32, scale=None):
+    """ Convert a MRC volume to MRC of the given mode (float32 by
+    default) reading and writing Z-slabs through memory maps, so that
+    peak memory is bounded by slabBytes regardless of the box size.
+    Values are multiplied by scale if given, and rounded if the
+    output mode is an integer one.
+    """
+    with mrcfile.mmap(inFn, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        shape = data.shape
+        unlinkOutput(outFn)
+        with mrcfile.new_mmap(outFn, shape, mrc_mode=mode,
+                              overwrite=True) as mrcOut:
+            sliceBytes = shape[1] * shape[2] * 4
+            integer = np.issubdtype(mrcOut.data.dtype, np.integer)
+            for start, end in iterSlabs(shape[0], sliceBytes, slabBytes):
+                slab = data[start:end].astype(np.float32)
+                if scale is not None:
+                    slab *= scale
+                if integer:
+                    slab = np.rint(slab)
+                mrcOut.data[start:end] = slab
+            mrcOut.voxel_size = mrcIn.voxel_size
+            mrcOut.update_header_stats()
+
+
+def _isStreamable(index, header):
+    """ Return True if the MRC volume can be converted slab-wise. """
+    return (index == 1 and header is not None and not header['stack']
+            and header['mode'] in REAL_MODES
+            and header['axes'] == (1, 2, 3))
+
+
+def compactVolume(fn, mode, scale=None):
+    """ Transcode the MRC volume fn to the given mode. The new data
+    is written to a new file that then replaces fn, so other hard
+    links to the original file (e.g. in the cache) are not modified.
+    """
+    tmpFn = fn + '.tmp'
+    convertVolumeSlabs(fn, tmpFn, mode=mode, scale=scale)
+    os.replace(tmpFn, fn)
+    return fn
+
+
+def _getLinkModes(mode):
+    """ MRC modes that can be linked when staging to mode. """
+    return (MODE_FLOAT32, mode)
+
+
+def getStageMethod(location, mode=MODE_FLOAT32):
+    """ Return how stageHalfMap would stage the given location. """
+    index, path = splitLocation(location)
+    header = readMrcHeader(path)
+
+    if index == 1 and isMrcCompatible(header, _getLinkModes(mode)):
+        return STAGE_LINK
+    if _isStreamable(index, header):
+        return STAGE_SLABS
+    return STAGE_CONVERT
+
+
+def stageHalfMap(location, outFn, mode=MODE_FLOAT32):
+    """ Make the input half-map available as MRC at outFn, float32 by
+    default or float16 if mode is MODE_FLOAT16. Compatible MRC inputs
+    are linked without copying any data, other MRC volumes are
+    transcoded slab-wise and everything else (stacks, non-MRC formats,
+    non-standard axis order) goes through ImageHandler.
+    Return the staging method used.
+    """
+    method = getStageMethod(location, mode)
+    path = splitLocation(location)[1]
+
+    if method == STAGE_LINK:
+        linkFile(path, outFn)
+    elif method == STAGE_SLABS:
+        convertVolumeSlabs(path, outFn, mode=mode)
+    else:
+        unlinkOutput(outFn)
+        ImageHandler().convert(location, outFn)
+        if mode != MODE_FLOAT32:
+            compactVolume(outFn, mode)
+
+    return method
+
+
+def _clipSlabs(data, mrcOut, slabBytes):
+    """ Write data clipped to [0, 1] into mrcOut, Z-slab by Z-slab. """
+    nz, ny, nx = data.shape
+    for start, end in iterSlabs(nz, ny * nx * 8, slabBytes):
+        mrcOut.data[start:end] = np.clip(data[start:end], 0, 1)
+
+
+def _resampleSlabs(data, tmpOut, newDim, slabBytes):
+    """ Fourier-resample each Z slice of data to newDim x newDim. """
+    nz, ny, nx = data.shape
+    sliceBytes = max(ny, newDim) * max(nx, newDim) * 16
+    for start, end in iterSlabs(nz, sliceBytes, slabBytes):
+        slab = resample(data[start:end].astype(np.float32), newDim, axis=2)
+        tmpOut[start:end] = resample(slab, newDim, axis=1)
+
+
+def _resampleColumns(tmp, out, newDim, slabBytes):
+    """ Fourier-resample along Z, a block of Y rows at a time. """
+    nz = tmp.shape[0]
+    rowBytes = max(nz, newDim) * newDim * 16
+    for start, end in iterSlabs(newDim, rowBytes, slabBytes):
+        out[:, start:end] = resample(tmp[:, start:end], newDim, axis=0)
+
+
+def _resampleVolume(data, outFn, newDim, voxelSize, clip, slabBytes):
+    """ Fourier-resample data to a cubic box of newDim one axis at a
+    time: first every Z slice is resampled in X and Y into a temporary
+    file, then the Z columns are resampled a block of rows at a time.
+    Since the Fourier transform is separable this is equivalent to
+    resampling the whole volume at once.
+    """
+    scale = data.shape[2] / float(newDim)
+    tmpFn = outFn + '.tmp'
+    unlinkOutput(tmpFn)
+    with mrcfile.new_mmap(tmpFn, (data.shape[0], newDim, newDim),
+                          mrc_mode=2, overwrite=True) as mrcTmp:
+        _resampleSlabs(data, mrcTmp.data, newDim, slabBytes)
+        unlinkOutput(outFn)
+        with mrcfile.new_mmap(outFn, (newDim,) * 3, mrc_mode=2,
+                              overwrite=True) as mrcOut:
+            _resampleColumns(mrcTmp.data, mrcOut.data, newDim, slabBytes)
+            if clip:
+                _clipSlabs(mrcOut.data, mrcOut, slabBytes)
+            mrcOut.voxel_size = voxelSize * scale
+    os.remove(tmpFn)
+
+
+def prepareMask(inFn, outFn, newDim=None, slabBytes=SLAB_BYTES):
+    """ Truncate the values of a MRC mask to [0, 1] and optionally
+    resize it to a cubic box of newDim, reading and writing through
+    memory maps so that peak memory is bounded by slabBytes.
+    Resizing is done in Fourier space (see _resampleVolume).
+    """
+    with mrcfile.mmap(inFn, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        voxelSize = float(mrcIn.voxel_size.x)
+
+        if newDim is None or data.shape == (newDim,) * 3:
+            unlinkOutput(outFn)
+            with mrcfile.new_mmap(outFn, data.shape, mrc_mode=2,
+                                  overwrite=True) as mrcOut:
+                _clipSlabs(data, mrcOut, slabBytes)
+                mrcOut.voxel_size = voxelSize
+        else:
+            _resampleVolume(data, outFn, newDim, voxelSize, True, slabBytes)
+
+    return outFn
+
+
+def binVolume(inFn, outFn, factor, slabBytes=SLAB_BYTES):
+    """ Reduce the box of a cubic MRC volume by factor cropping its
+    Fourier transform, so that the binned map keeps all frequencies
+    up to the new Nyquist without aliasing.
+    """
+    with mrcfile.mmap(inFn, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        _resampleVolume(data, outFn, data.shape[2] // factor,
+                        float(mrcIn.voxel_size.x), False, slabBytes)
+    return outFn
+
+
+def _bfactorWeights(n, voxelSize, bfactor):
+    """ 1D factor of exp(-B s^2 / 4) along an axis of n voxels. """
+    s2 = np.fft.fftfreq(n, d=voxelSize) ** 2
+    return np.exp(-bfactor * s2 / 4).astype(np.float32)
+
+
+def combineHalves(half1Fn, half2Fn, outFn, bfactor=0,
+                  slabBytes=SLAB_BYTES):
+    """ Write the average of two half-maps to outFn, optionally
+    applying a B-factor (negative values sharpen) in Fourier space.
+    Since exp(-B s^2 / 4) is separable, the B-factor is applied while
+    averaging each Z slab (in X and Y) and then along Z a block of
+    rows at a time, so only slabs are kept in memory.
+    """
+    with mrcfile.mmap(half1Fn, mode='r', permissive=True) as mrc1, \
+            mrcfile.mmap(half2Fn, mode='r', permissive=True) as mrc2:
+        shape = mrc1.data.shape
+        nz, ny, nx = shape
+        voxelSize = float(mrc1.voxel_size.x)
+        if bfactor:
+            wy = _bfactorWeights(ny, voxelSize, bfactor)
+            wx = _bfactorWeights(nx, voxelSize, bfactor)[:nx // 2 + 1]
+            wxy = wy[:, None] * wx[None, :]
+
+        unlinkOutput(outFn)
+        with mrcfile.new_mmap(outFn, shape, mrc_mode=2,
+                              overwrite=True) as mrcOut:
+            out = mrcOut.data
+            for start, end in iterSlabs(nz, ny * nx * 16, slabBytes):
+                slab = (mrc1.data[start:end].astype(np.float32) +
+                        mrc2.data[start:end]) / 2
+                if bfactor:
+                    f = np.fft.rfft2(slab) * wxy
+                    slab = np.fft.irfft2(f, s=(ny, nx))
+                out[start:end] = slab
+
+            if bfactor:
+                wz = _bfactorWeights(nz, voxelSize, bfactor)[:, None, None]
+                for start, end in iterSlabs(ny, nz * nx * 16, slabBytes):
+                    f = np.fft.fft(out[:, start:end], axis=0) * wz
+                    out[:, start:end] = np.fft.ifft(f, axis=0).real
+
+            mrcOut.voxel_size = voxelSize
+            mrcOut.update_header_stats()
+
+    return outFn
+
+
+def convertMask(img, outFn, newDim=None, mode=MODE_FLOAT32):
     """ Convert binary mask to a format read by Relion and truncate the
     values between 0-1 values, due to Relion only support masks with this
-    values (0-1).
+    values (0-1). MRC masks are processed in Z-slabs by prepareMask,
+    other formats are read into memory by ImageHandler.
     Params:
         img: input image to be converted.
         outFn: output file path.
+        newDim: box size of the output mask, if different from the input.
+        mode: MODE_FLOAT32, or MODE_INT8 to store values in [0, 1]
+            as [0, MASK_LEVELS], only read by the native engine.
     Return:
         new file name of the mask.
     """
-
-    ih = ImageHandler()
     imgFn = getImageLocation(img.getLocation())
-    ih.truncateMask(imgFn, outFn, newDim=newDim)
+    index, path = splitLocation(imgFn)
+
+    if _isStreamable(index, readMrcHeader(path)):
+        prepareMask(path, outFn, newDim=newDim)
+    else:
+        unlinkOutput(outFn)
+        ih = ImageHandler()
+        ih.truncateMask(imgFn, outFn, newDim=newDim)
+
+    if mode == MODE_INT8:
+        compactVolume(outFn, MODE_INT8, scale=MASK_LEVELS)
 
     return outFn
+
+
+def _iterBinnedSlabs(nz, sliceBytes, factor, slabBytes):
+    """ Like iterSlabs, but slabs (except the last) have a number
+    of slices that is a multiple of factor.
+    """
+    step = max(1, slabBytes // max(sliceBytes, 1))
+    step = max(factor, step - step % factor)
+    for start in range(0, nz, step):
+        yield start, min(start + step, nz)
+
+
+def _binSlab(slab, factor, previewShape):
+    """ Average blocks of factor^3 voxels of a slab starting at a Z
+    multiple of factor, dropping voxels beyond previewShape.
+    """
+    pz = slab.shape[0] // factor
+    _, py, px = previewShape
+    block = slab[:pz * factor, :py * factor, :px * factor]
+    return block.reshape(pz, factor, py, factor,
+                         px, factor).mean(axis=(1, 3, 5))
+
+
+def readVolumeStats(inFn, previewFn=None, previewDim=PREVIEW_DIM,
+                    slabBytes=SLAB_BYTES):
+    """ Read a MRC volume once through a memory map and return its
+    header metadata together with min, max, mean and std. If previewFn
+    is given, a preview binned to at most previewDim voxels per side
+    is written there in the same pass.
+    """
+    header = readMrcHeader(inFn)
+    if header is None:
+        raise ValueError("%s can not be read as MRC" % inFn)
+
+    with mrcfile.mmap(inFn, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        nz, ny, nx = data.shape
+        factor = max(1, -(-max(data.shape) // previewDim))
+        previewShape = tuple(max(1, d // factor) for d in data.shape)
+        preview = np.zeros(previewShape, dtype=np.float32)
+
+        count, mean, m2 = 0, 0.0, 0.0
+        vMin, vMax = np.inf, -np.inf
+        for start, end in _iterBinnedSlabs(nz, ny * nx * 4, factor,
+                                           slabBytes):
+            slab = np.asarray(data[start:end], dtype=np.float32)
+            # Chan et al. update, so that std does not lose precision
+            # in large boxes
+            n = slab.size
+            slabMean = float(slab.mean(dtype=np.float64))
+            slabM2 = float(((slab - slabMean) ** 2).sum(dtype=np.float64))
+            delta = slabMean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += slabM2 + delta ** 2 * count * n / total
+            count = total
+            vMin = min(vMin, float(slab.min()))
+            vMax = max(vMax, float(slab.max()))
+
+            pStart = start // factor
+            binned = _binSlab(slab, factor, previewShape)
+            pEnd = min(pStart + binned.shape[0], previewShape[0])
+            preview[pStart:pEnd] = binned[:pEnd - pStart]
+
+    if previewFn is not None:
+        unlinkOutput(previewFn)
+        with mrcfile.new(previewFn, data=preview, overwrite=True) as mrcOut:
+            mrcOut.voxel_size = header['voxelSize'] * factor
+
+    stats = dict(header)
+    stats.update({'min': vMin, 'max': vMax, 'mean': mean,
+                  'std': (m2 / count) ** 0.5,
+                  'preview': previewFn})
+    return stats
+
+
+def setVolumeStats(vol, stats):
+    """ Store the result of readVolumeStats as attributes of a Volume,
+    so that it is persisted with the output and can be used without
+    opening the volume file.
+    """
+    for key in STATS_ATTRS:
+        setattr(vol, '_sidesplitter_%s' % key, Float(stats[key]))
+    vol._sidesplitter_dims = String('%d,%d,%d' % tuple(stats['dims']))
+    if stats.get('preview'):
+        vol._sidesplitter_preview = String(stats['preview'])
+
+
+def getVolumeStats(vol):
+    """ Return the statistics stored by setVolumeStats as a dict with
+    the same keys as readVolumeStats, or None if they are not there.
+    """
+    dims = getattr(vol, '_sidesplitter_dims', None)
+    if dims is None:
+        return None
+    stats = {key: getattr(vol, '_sidesplitter_%s' % key).get()
+             for key in STATS_ATTRS}
+    stats['dims'] = tuple(int(d) for d in dims.get().split(','))
+    preview = getattr(vol, '_sidesplitter_preview', None)
+    stats['preview'] = preview.get() if preview is not None else None
+    return stats
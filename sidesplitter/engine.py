@@ -0,0 +1,586 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Native implementation of the SIDESPLITTER local filter.
+
+The half-maps are decomposed into overlapping Fourier shells. In every
+shell the local signal (correlation between the halves) and the local
+noise (their difference) are averaged in a real-space window that
+scales with the wavelength of the shell, and each voxel is attenuated
+by its local SNR. By default the radial spectrum of each filtered half
+is then rescaled to match the input one; with --spectrum the SNR
+weighted spectrum is kept.
+
+Large volumes can be processed in overlapping tiles by a pool of
+processes sharing the volumes through shared memory (see filterTiled),
+or by MPI ranks, possibly on different nodes (see filterMpi). The MPI
+mode needs mpi4py and can be tried on a single machine with:
+
+    mpirun -np 4 python -m sidesplitter.engine --v1 half1.mrc --v2 half2.mrc --tile 64 --mpi
+
+This module can be run as a program with the same arguments as the
+SIDESPLITTER binary:
+
+    python -m sidesplitter.engine --v1 half1.mrc --v2 half2.mrc [--mask mask.mrc] [--spectrum] [--tile 128 --pad 16]
+"""
+
+import os
+import argparse
+import itertools
+import functools
+from multiprocessing import Pool, Lock
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import mrcfile
+from scipy import fft
+
+from .shells import getShellRadius, getShellIndex
+
+
+# Masks stored as int8 MRC (mode 0) use this value for 1
+MASK_LEVELS = 127
+
+# Local SNR of a half-map at which the local FSC between both halves
+# would cross 0.143 (FSC = SNR / (1 + SNR))
+LOCRES_SNR = 0.143 / (1 - 0.143)
+
+
+class LocalFilter:
+    """ Local SNR filter for a given box shape.
+
+    All frequency-dependent arrays (radius, shell weights, window
+    transfer functions) are computed once and reused for every shell
+    and every pair of maps of the same shape, the radius and shell
+    indexes being shared through sidesplitter.shells; scipy.fft also
+    keeps its plans cached between transforms of the same size.
+    """
+    def __init__(self, shape, shellWidth=2.0, windowScale=1.0,
+                 minWindow=2.0, workers=1):
+        self.shape = tuple(shape)
+        self.shellWidth = float(shellWidth)
+        self.windowScale = float(windowScale)
+        self.minWindow = float(minWindow)
+        self.workers = workers
+        self.radius = getShellRadius(self.shape)
+        nShells = int(np.ceil(self.radius.max() / self.shellWidth))
+        self.centers = [self.shellWidth * i for i in range(nShells + 1)]
+
+    def _shellWeight(self, i):
+        """ Triangular weight of shell i, all shells add up to one. """
+        w = 1 - np.abs(self.radius - self.centers[i]) / self.shellWidth
+        if i == len(self.centers) - 1:
+            w[self.radius > self.centers[i]] = 1
+        return np.clip(w, 0, 1, out=w)
+
+    def _window(self, center):
+        """ Transfer function of the Gaussian window used to average
+        the local statistics of the shell at the given radius.
+        """
+        n = min(self.shape)
+        sigma = self.windowScale * n / max(center, 1.0)
+        sigma = min(max(sigma, self.minWindow), n / 4.0)
+        return np.exp(-2 * (np.pi * sigma / n * self.radius) ** 2)
+
+    def _smooth(self, data, window):
+        return fft.irfftn(fft.rfftn(data, workers=self.workers) * window,
+                          s=self.shape, workers=self.workers)
+
+    def iterShells(self, f1, f2, mask=None):
+        """ Yield (center, g1, g2, snr) for every shell, where g1 and
+        g2 are the band-passed half-maps and snr the local SNR.
+        f1 and f2 are the rfft of the half-maps.
+        """
+        for i, center in enumerate(self.centers):
+            shell = self._shellWeight(i)
+            g1 = fft.irfftn(f1 * shell, s=self.shape, workers=self.workers)
+            g2 = fft.irfftn(f2 * shell, s=self.shape, workers=self.workers)
+
+            if i == 0:
+                # The lowest shell is always kept
+                yield center, g1, g2, None
+                continue
+
+            window = self._window(center)
+            signal = self._smooth(g1 * g2, window)
+            noise = self._smooth((g1 - g2) ** 2, window) / 2
+            if mask is not None:
+                signal *= mask
+            snr = np.maximum(signal, 0) / np.maximum(noise, 1e-12)
+            yield center, g1, g2, snr
+
+    def filter(self, half1, half2, mask=None, spectrum=False, locres=False):
+        """ Return the locally filtered half-maps. If locres is True,
+        the local resolution is also returned, in voxels: the
+        wavelength of the last shell, going up from low frequencies,
+        where the local SNR stays above LOCRES_SNR.
+        """
+        half1 = np.asarray(half1, dtype=np.float32)
+        half2 = np.asarray(half2, dtype=np.float32)
+        f1 = fft.rfftn(half1, workers=self.workers)
+        f2 = fft.rfftn(half2, workers=self.workers)
+        out1 = np.zeros(self.shape, dtype=np.float32)
+        out2 = np.zeros(self.shape, dtype=np.float32)
+        if locres:
+            n = min(self.shape)
+            # Voxels not resolved at any shell get the lowest one
+            res = np.full(self.shape, n / self.centers[1], dtype=np.float32)
+            resolved = np.ones(self.shape, dtype=bool)
+
+        for center, g1, g2, snr in self.iterShells(f1, f2, mask):
+            if snr is None:
+                out1 += g1
+                out2 += g2
+            else:
+                weight = snr / (1 + snr)
+                out1 += weight * g1
+                out2 += weight * g2
+                # Shells beyond Nyquist (box corners) are not used
+                if locres and center <= n / 2:
+                    resolved &= snr >= LOCRES_SNR
+                    res[resolved] = n / center
+
+        if not spectrum:
+            out1 = self.matchSpectrum(out1, f1)
+            out2 = self.matchSpectrum(out2, f2)
+
+        if locres:
+            return out1, out2, res
+        return out1, out2
+
+    def matchSpectrum(self, data, ref):
+        """ Rescale the radial power spectrum of data to the one of
+        the reference rfft ref.
+        """
+        fData = fft.rfftn(data, workers=self.workers)
+        shells = getShellIndex(self.shape).ravel()
+        nBins = shells.max() + 1
+        pRef = np.bincount(shells, (np.abs(ref) ** 2).ravel(), nBins)
+        pData = np.bincount(shells, (np.abs(fData) ** 2).ravel(), nBins)
+        scale = np.sqrt(pRef / np.maximum(pData, 1e-30))
+        scale[pData <= 0] = 0
+        fData *= scale[shells].reshape(fData.shape).astype(np.float32)
+        return fft.irfftn(fData, s=self.shape,
+                          workers=self.workers).astype(np.float32)
+
+
+class Tile:
+    """ Sub-box of a volume processed independently.
+
+    The filter runs on the padded box, and the result is accumulated
+    in the write box (the core extended by the blending margin) with
+    linear ramps, so that the weights of neighbouring tiles add up
+    to one.
+    """
+    def __init__(self, cores, shape, pad, blend):
+        self.padded = tuple(slice(max(a - pad, 0), min(b + pad, n))
+                            for (a, b), n in zip(cores, shape))
+        self.write = tuple(slice(max(a - blend, 0), min(b + blend, n))
+                           for (a, b), n in zip(cores, shape))
+        self.cores = cores
+        self.shape = shape
+        self.blend = blend
+
+    def weights(self):
+        """ Blending weights of the write box. """
+        profiles = []
+        for (a, b), s, n in zip(self.cores, self.write, self.shape):
+            x = np.arange(s.start, s.stop, dtype=np.float32) + 0.5
+            w = np.ones_like(x)
+            if self.blend and a > 0:
+                w *= np.clip((x - a + self.blend) / (2 * self.blend), 0, 1)
+            if self.blend and b < n:
+                w *= np.clip((b + self.blend - x) / (2 * self.blend), 0, 1)
+            profiles.append(w)
+        return (profiles[0][:, None, None] * profiles[1][None, :, None] *
+                profiles[2][None, None, :])
+
+    def writeInPadded(self):
+        """ Slices of the write box relative to the padded box. """
+        return tuple(slice(w.start - p.start, w.stop - p.start)
+                     for w, p in zip(self.write, self.padded))
+
+
+def splitTiles(shape, tileSize, pad, blend=None):
+    """ Split a volume of the given shape in tiles of about tileSize
+    voxels (plus padding) along each axis.
+    """
+    axes = []
+    for n in shape:
+        nTiles = max(1, int(round(n / float(tileSize))))
+        edges = np.linspace(0, n, nTiles + 1).astype(int)
+        axes.append(list(zip(edges[:-1], edges[1:])))
+
+    minCore = min(b - a for axis in axes for a, b in axis)
+    if blend is None:
+        blend = pad // 2
+    blend = min(blend, pad, minCore // 2)
+
+    return [Tile(cores, shape, pad, blend)
+            for cores in itertools.product(*axes)]
+
+
+class SharedVolumes:
+    """ Volumes stored in shared memory blocks, so that the tile
+    workers read the inputs and write the outputs without copies.
+    """
+    def __init__(self, shape, names=None):
+        self.shape = tuple(shape)
+        nbytes = int(np.prod(self.shape)) * 4
+        self.owner = names is None
+        if self.owner:
+            names = {}
+        self._blocks = {}
+        self.arrays = {}
+        for key in (names or {}):
+            self._attach(key, SharedMemory(name=names[key]))
+        self._nbytes = nbytes
+
+    def _attach(self, key, block):
+        self._blocks[key] = block
+        self.arrays[key] = np.ndarray(self.shape, dtype=np.float32,
+                                      buffer=block.buf)
+
+    def create(self, key, data=None):
+        block = SharedMemory(create=True, size=self._nbytes)
+        self._attach(key, block)
+        if data is None:
+            self.arrays[key][:] = 0
+        else:
+            self.arrays[key][:] = data
+        return self.arrays[key]
+
+    @property
+    def names(self):
+        return {key: block.name for key, block in self._blocks.items()}
+
+    def close(self):
+        self.arrays = {}
+        for block in self._blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self._blocks = {}
+
+
+# Tile size used in MPI mode when none is given
+DEFAULT_MPI_TILE = 128
+
+# State of the tile worker processes
+_worker = {}
+
+
+# Keys of the accumulated tile outputs, the local resolution is optional
+OUTPUT_KEYS = ('out1', 'out2', 'locres')
+
+
+def _initWorker(shape, names, spectrum, workers, lock, locres=False):
+    _worker['lock'] = lock
+    _worker['volumes'] = SharedVolumes(shape, names)
+    _worker['spectrum'] = spectrum
+    _worker['workers'] = workers
+    _worker['filters'] = {}
+    _worker['locres'] = locres
+
+
+def filterTileData(tile, half1, half2, mask=None, spectrum=True,
+                   filters=None, workers=1, locres=False):
+    """ Filter the padded box data of a tile and return both halves
+    of its write box (and the local resolution if locres), already
+    multiplied by the blending weights.
+    filters caches the LocalFilter of each tile shape.
+    """
+    filters = {} if filters is None else filters
+    if half1.shape not in filters:
+        filters[half1.shape] = LocalFilter(half1.shape, workers=workers)
+    outs = filters[half1.shape].filter(half1, half2, mask,
+                                       spectrum=spectrum, locres=locres)
+    inner = tile.writeInPadded()
+    weights = tile.weights()
+    return tuple(weights * out[inner] for out in outs)
+
+
+def filterTile(tile, arrays, spectrum=True, filters=None, workers=1,
+               lock=None, locres=False):
+    """ Filter one tile of the volumes in arrays and accumulate the
+    result into the 'out1' and 'out2' arrays (and 'locres'). The
+    accumulation is done holding lock, if given, since neighbouring
+    tiles overlap.
+    """
+    mask = arrays['mask'][tile.padded] if 'mask' in arrays else None
+    outs = filterTileData(tile, arrays['half1'][tile.padded],
+                          arrays['half2'][tile.padded], mask,
+                          spectrum, filters, workers, locres)
+    if lock is not None:
+        lock.acquire()
+    try:
+        for key, out in zip(OUTPUT_KEYS, outs):
+            arrays[key][tile.write] += out
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def _runTile(tile):
+    filterTile(tile, _worker['volumes'].arrays, _worker['spectrum'],
+               _worker['filters'], _worker['workers'], _worker['lock'],
+               _worker['locres'])
+
+
+def filterTiled(half1, half2, mask=None, spectrum=False, tileSize=128,
+                pad=16, processes=1, workers=1, locres=False):
+    """ Filter the half-maps tile by tile in a pool of processes.
+
+    Only the accumulation of each filtered tile into the outputs is
+    serialized. The spectrum is matched once on the blended volumes,
+    not per tile. If locres is True the blended local resolution of
+    the tiles is returned as a third volume.
+    """
+    shape = half1.shape
+    tiles = splitTiles(shape, tileSize, pad)
+    volumes = SharedVolumes(shape)
+    try:
+        volumes.create('half1', half1)
+        volumes.create('half2', half2)
+        if mask is not None:
+            volumes.create('mask', mask)
+        keys = OUTPUT_KEYS if locres else OUTPUT_KEYS[:2]
+        for key in keys:
+            volumes.create(key)
+
+        if processes > 1:
+            initArgs = (shape, volumes.names, True, workers, Lock(), locres)
+            with Pool(processes, initializer=_initWorker,
+                      initargs=initArgs) as pool:
+                pool.map(_runTile, tiles, chunksize=1)
+        else:
+            filters = {}
+            for tile in tiles:
+                filterTile(tile, volumes.arrays, True, filters, workers,
+                           locres=locres)
+
+        out1, out2 = [volumes.arrays[key].copy() for key in keys[:2]]
+        if locres:
+            res = volumes.arrays['locres'].copy()
+    finally:
+        volumes.close()
+
+    if not spectrum:
+        localFilter = LocalFilter(shape, workers=workers * processes)
+        out1 = localFilter.matchSpectrum(
+            out1, fft.rfftn(half1, workers=localFilter.workers))
+        out2 = localFilter.matchSpectrum(
+            out2, fft.rfftn(half2, workers=localFilter.workers))
+
+    if locres:
+        return out1, out2, res
+    return out1, out2
+
+
+def asMask(data):
+    """ Return mask data as float32 in [0, 1], undoing the int8
+    quantization of compact masks.
+    """
+    if data.dtype == np.int8:
+        return data.astype(np.float32) / MASK_LEVELS
+    return np.asarray(data, dtype=np.float32)
+
+
+def unlinkOutput(fn):
+    """ Remove the output file fn if it exists. Writers call this
+    before creating their output, so that a new inode is written and
+    other hard links to the old file (the input volumes of a
+    refinement, cache entries) are never modified.
+    """
+    if os.path.lexists(fn):
+        os.remove(fn)
+
+
+def readVolume(fn):
+    """ Return the data and the voxel size of a MRC volume. """
+    with mrcfile.open(fn, permissive=True) as mrc:
+        return np.asarray(mrc.data, dtype=np.float32), mrc.voxel_size.copy()
+
+
+def readMask(fn):
+    with mrcfile.open(fn, permissive=True) as mrc:
+        return asMask(mrc.data)
+
+
+def writeVolume(fn, data, voxelSize):
+    unlinkOutput(fn)
+    with mrcfile.new(fn, data.astype(np.float32), overwrite=True) as mrc:
+        mrc.voxel_size = voxelSize
+
+
+def filterMpi(comm, inputFns, outputFns, spectrum=False, tileSize=128,
+              pad=16, workers=1):
+    """ Filter the half-maps distributing the tiles among MPI ranks.
+
+    Every rank reads only the padded boxes of its own tiles from the
+    memory-mapped inputs, so no rank holds the full half-maps while
+    filtering. Filtered tiles are sent to rank 0, which accumulates
+    them into the memory-mapped outputs and matches the spectrum.
+    Params:
+        comm: MPI communicator (mpi4py).
+        inputFns: dict with 'half1', 'half2' and optionally 'mask'.
+        outputFns: output file names of both halves, and optionally
+            of the local resolution map.
+    """
+    locres = len(outputFns) > 2
+    rank, size = comm.Get_rank(), comm.Get_size()
+    mrcs = {key: mrcfile.mmap(fn, mode='r', permissive=True)
+            for key, fn in inputFns.items()}
+    shape = mrcs['half1'].data.shape
+    tiles = splitTiles(shape, tileSize, pad)
+    myTiles = range(rank, len(tiles), size)
+    filters = {}
+
+    def process(i):
+        data = {key: np.asarray(mrc.data[tiles[i].padded], dtype=np.float32)
+                for key, mrc in mrcs.items() if key != 'mask'}
+        if 'mask' in mrcs:
+            data['mask'] = asMask(mrcs['mask'].data[tiles[i].padded])
+        return filterTileData(tiles[i], data['half1'], data['half2'],
+                              data.get('mask'), True, filters, workers,
+                              locres)
+
+    if rank != 0:
+        for i in myTiles:
+            comm.send((i,) + process(i), dest=0, tag=1)
+    else:
+        for fn in outputFns:
+            unlinkOutput(fn)
+        outs = [mrcfile.new_mmap(fn, shape, mrc_mode=2, overwrite=True)
+                for fn in outputFns]
+
+        def accumulate(i, *tileOuts):
+            for out, data in zip(outs, tileOuts):
+                out.data[tiles[i].write] += data
+
+        pending = len(tiles) - len(myTiles)
+        for i in myTiles:
+            accumulate(i, *process(i))
+            while pending and comm.iprobe(tag=1):
+                accumulate(*comm.recv(tag=1))
+                pending -= 1
+        for _ in range(pending):
+            accumulate(*comm.recv(tag=1))
+
+        localFilter = LocalFilter(shape, workers=workers)
+        for out, key in zip(outs, ['half1', 'half2']):
+            if not spectrum:
+                ref = fft.rfftn(np.asarray(mrcs[key].data, dtype=np.float32),
+                                workers=workers)
+                out.data[:] = localFilter.matchSpectrum(out.data, ref)
+            out.voxel_size = mrcs[key].voxel_size
+            out.close()
+        if locres:
+            voxelSize = mrcs['half1'].voxel_size
+            outs[2].data[:] *= float(voxelSize.x)
+            outs[2].voxel_size = voxelSize
+            outs[2].close()
+
+    for mrc in mrcs.values():
+        mrc.close()
+
+
+@functools.lru_cache(maxsize=2)
+def getLocalFilter(shape, workers=1):
+    """ Return a LocalFilter for shape, reusing the last ones created.
+    This matters in long-lived processes (see sidesplitter.service)
+    that filter many maps of the same size.
+    """
+    return LocalFilter(shape, workers=workers)
+
+
+def getOutputFn(fn):
+    """ Output file name used by SIDESPLITTER for an input half-map. """
+    return os.path.splitext(fn)[0] + '_sidesplitter.mrc'
+
+
+def getThreads():
+    """ Threads are passed through OMP_NUM_THREADS as for the binary. """
+    return max(int(os.environ.get('OMP_NUM_THREADS', 1)), 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='sidesplitter.engine',
+        description='Native implementation of the SIDESPLITTER local filter.')
+    parser.add_argument('--v1', required=True, help='First half-map.')
+    parser.add_argument('--v2', required=True, help='Second half-map.')
+    parser.add_argument('--mask', help='Mask with values in [0, 1], or '
+                                       'int8 values in [0, %d].' % MASK_LEVELS)
+    parser.add_argument('--spectrum', action='store_true',
+                        help='Output the SNR weighted spectrum.')
+    parser.add_argument('--tile', type=int, default=0,
+                        help='Process the volume in tiles of this size, '
+                             'using one process per thread.')
+    parser.add_argument('--pad', type=int, default=16,
+                        help='Padding added around each tile.')
+    parser.add_argument('--mpi', action='store_true',
+                        help='Distribute the tiles among MPI ranks.')
+    parser.add_argument('--locres',
+                        help='Also write the local resolution map (in A) '
+                             'estimated from the local SNR to this file.')
+    args = parser.parse_args(argv)
+    outputFns = [getOutputFn(args.v1), getOutputFn(args.v2)]
+    if args.locres:
+        outputFns.append(args.locres)
+
+    if args.mpi:
+        from mpi4py import MPI
+        inputFns = {'half1': args.v1, 'half2': args.v2}
+        if args.mask:
+            inputFns['mask'] = args.mask
+        filterMpi(MPI.COMM_WORLD, inputFns, outputFns, args.spectrum,
+                  tileSize=args.tile or DEFAULT_MPI_TILE, pad=args.pad,
+                  workers=getThreads())
+        return
+
+    half1, voxelSize = readVolume(args.v1)
+    half2 = readVolume(args.v2)[0]
+    mask = readMask(args.mask) if args.mask else None
+
+    locres = bool(args.locres)
+    if args.tile:
+        outs = filterTiled(half1, half2, mask, args.spectrum,
+                           tileSize=args.tile, pad=args.pad,
+                           processes=getThreads(), locres=locres)
+    else:
+        localFilter = getLocalFilter(half1.shape, getThreads())
+        outs = localFilter.filter(half1, half2, mask, args.spectrum, locres)
+
+    if locres:
+        # Local resolution is computed in voxels
+        outs = outs[:2] + (outs[2] * float(voxelSize.x),)
+    for fn, out in zip(outputFns, outs):
+        writeVolume(fn, out, voxelSize)
+
+
+if __name__ == '__main__':
+    main()
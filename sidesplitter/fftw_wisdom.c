@@ -0,0 +1,73 @@
+/*
+ * FFTW wisdom persistence for the SIDESPLITTER binary.
+ *
+ * This file is compiled together with the SIDESPLITTER sources when the
+ * plugin is installed, without modifying them. If SIDESPLITTER_WISDOM_FILE
+ * is set, wisdom is imported from that file right after fftw_init_threads()
+ * (FFTW requires it to be called before any other FFTW routine) and
+ * exported back to it when the program exits (or right before
+ * fftw_cleanup(), which forgets it), so later runs with the same box size
+ * and threads do not need to plan their FFTs again. The file is replaced
+ * atomically, so concurrent runs do not corrupt it.
+ *
+ * Link with -Wl,--wrap=fftw_init_threads -Wl,--wrap=fftw_cleanup.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <fftw3.h>
+
+int __real_fftw_init_threads(void);
+void __real_fftw_cleanup(void);
+
+static int wisdomImported = 0;
+static int wisdomExported = 0;
+
+static void importWisdom(void)
+{
+    const char *fn = getenv("SIDESPLITTER_WISDOM_FILE");
+
+    if (fn == NULL || wisdomImported)
+        return;
+    wisdomImported = 1;
+
+    fftw_import_wisdom_from_filename(fn);
+}
+
+static void exportWisdom(void)
+{
+    const char *fn = getenv("SIDESPLITTER_WISDOM_FILE");
+    char tmpFn[4096];
+
+    if (fn == NULL || wisdomExported)
+        return;
+    wisdomExported = 1;
+
+    snprintf(tmpFn, sizeof(tmpFn), "%s.%d", fn, (int) getpid());
+    if (fftw_export_wisdom_to_filename(tmpFn))
+        rename(tmpFn, fn);
+    else
+        remove(tmpFn);
+}
+
+__attribute__((destructor))
+static void exportWisdomAtExit(void)
+{
+    exportWisdom();
+}
+
+int __wrap_fftw_init_threads(void)
+{
+    int ok = __real_fftw_init_threads();
+
+    if (ok)
+        importWisdom();
+    return ok;
+}
+
+void __wrap_fftw_cleanup(void)
+{
+    exportWisdom();
+    __real_fftw_cleanup();
+}
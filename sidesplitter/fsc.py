@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Fourier shell correlation of half-maps read from memory-mapped MRC files.
+
+The rfft of each half is computed a Z slab at a time (in X and Y) and
+then along Z, so the input volumes are never loaded as a whole, and
+the correlation is binned into shells with np.bincount a Z slab at a
+time, using the shell indexes shared with the filter (see sidesplitter.shells). Both the
+unmasked and the masked curves are computed from the same read of
+the half-maps.
+"""
+
+import numpy as np
+import mrcfile
+from scipy import fft
+
+from .convert import SLAB_BYTES, iterSlabs
+from .engine import asMask
+from .shells import (getShellIndex, getHermitianWeights, getNumberOfShells,
+                     getShellFrequencies)
+
+
+# Resolution criterion reported for the FSC curves
+FSC_THRESHOLD = 0.143
+
+
+def _rfftSlabs(transforms, data, mask=None, slabBytes=SLAB_BYTES):
+    """ Fill transforms (a list with one or two complex arrays) with the
+    rfft of data and, if a mask is given, of data times the mask.
+    """
+    nz, ny, nx = data.shape
+    for start, end in iterSlabs(nz, ny * nx * 4, slabBytes):
+        slab = np.asarray(data[start:end], dtype=np.float32)
+        transforms[0][start:end] = fft.rfft2(slab)
+        if mask is not None:
+            slab = slab * asMask(mask[start:end])
+            transforms[1][start:end] = fft.rfft2(slab)
+
+    for f in transforms:
+        for start, end in iterSlabs(ny, nz * f.shape[-1] * 8, slabBytes):
+            f[:, start:end] = fft.fft(f[:, start:end], axis=0)
+
+
+def _correlate(f1, f2, shells, weights, nShells, slabBytes=SLAB_BYTES):
+    """ FSC between two transforms for shells 0..nShells-1, binned a
+    Z slab at a time so that no copies of the transforms are made.
+    """
+    num, d1, d2 = [np.zeros(nShells) for _ in range(3)]
+    nz, ny, nx = f1.shape
+    for start, end in iterSlabs(nz, ny * nx * 32, slabBytes):
+        slabShells = shells[start:end]
+        keep = slabShells < nShells
+        idx = slabShells[keep]
+        w = np.broadcast_to(weights, slabShells.shape)[keep]
+        a, b = f1[start:end][keep], f2[start:end][keep]
+        num += np.bincount(idx, (a * b.conj()).real * w, minlength=nShells)
+        d1 += np.bincount(idx, (a * a.conj()).real * w, minlength=nShells)
+        d2 += np.bincount(idx, (b * b.conj()).real * w, minlength=nShells)
+    den = np.sqrt(d1 * d2)
+    return np.divide(num, den, out=np.zeros(nShells), where=den > 0)
+
+
+def computeFsc(half1Fn, half2Fn, maskFn=None, shellsDir=None,
+               voxelSize=None, slabBytes=SLAB_BYTES):
+    """ Compute the FSC between two half-maps.
+    Params:
+        half1Fn, half2Fn: MRC files of the half-maps.
+        maskFn: optional MRC mask (float or int8 compact mask).
+        shellsDir: folder with the saved shells, see sidesplitter.shells.
+        voxelSize: in A, read from the header of half1Fn if not given.
+    Return:
+        a tuple (freqs, fsc, maskedFsc) with the spatial frequencies
+        in 1/A up to Nyquist, the unmasked FSC and the masked FSC
+        (None if no mask is given).
+    """
+    with mrcfile.mmap(half1Fn, mode='r', permissive=True) as mrc1, \
+            mrcfile.mmap(half2Fn, mode='r', permissive=True) as mrc2:
+        shape = mrc1.data.shape
+        if voxelSize is None:
+            voxelSize = float(mrc1.voxel_size.x)
+        if voxelSize <= 0:
+            raise ValueError("%s has no voxel size, it must be given."
+                             % half1Fn)
+        fshape = shape[:-1] + (shape[-1] // 2 + 1,)
+        nTransforms = 1 if maskFn is None else 2
+        f1 = [np.empty(fshape, np.complex64) for _ in range(nTransforms)]
+        f2 = [np.empty(fshape, np.complex64) for _ in range(nTransforms)]
+
+        mrcMask = (mrcfile.mmap(maskFn, mode='r', permissive=True)
+                   if maskFn else None)
+        try:
+            mask = mrcMask.data if mrcMask else None
+            _rfftSlabs(f1, mrc1.data, mask, slabBytes)
+            _rfftSlabs(f2, mrc2.data, mask, slabBytes)
+        finally:
+            if mrcMask:
+                mrcMask.close()
+
+    shells = getShellIndex(shape, shellsDir)
+    weights = getHermitianWeights(shape)
+    nShells = getNumberOfShells(shape)
+    freqs = getShellFrequencies(shape, voxelSize)
+    curves = [_correlate(a, b, shells, weights, nShells, slabBytes)
+              for a, b in zip(f1, f2)]
+    if maskFn is None:
+        curves.append(None)
+
+    return (freqs,) + tuple(curves)
+
+
+def getFscResolution(freqs, fsc, threshold=FSC_THRESHOLD):
+    """ Return the resolution (A) where the FSC first drops below
+    threshold, interpolating between shells, or the Nyquist
+    resolution if it never does.
+    """
+    freqs, fsc = np.asarray(freqs), np.asarray(fsc)
+    below = np.nonzero(fsc[1:] < threshold)[0]
+    if not len(below):
+        return 1 / freqs[-1]
+    i = below[0] + 1
+    t = (fsc[i - 1] - threshold) / (fsc[i - 1] - fsc[i])
+    return 1 / (freqs[i - 1] + t * (freqs[i] - freqs[i - 1]))
@@ -25,3 +25,5 @@
 # **************************************************************************
 
 from .protocol_sidesplitter import ProtSideSplitter
+from .protocol_sidesplitter_batch import ProtSideSplitterBatch
+from .protocol_sidesplitter_streaming import ProtSideSplitterStreaming
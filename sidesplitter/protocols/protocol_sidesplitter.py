@@ -25,15 +25,37 @@
 # **************************************************************************
 
 import os
+import json
+import shutil
+import threading
 
 import pyworkflow.protocol.params as params
+from pyworkflow.object import String
 from pyworkflow.constants import PROD
+from pyworkflow.protocol.constants import STEPS_PARALLEL, STEPS_SERIAL
 from pwem.protocols import ProtAnalysis3D
-from pwem.objects import Volume
-from pwem.emlib.image import ImageHandler
+from pwem.objects import Volume, FSC, SetOfFSCs
 
 from sidesplitter import Plugin
-from ..convert import convertMask
+from ..constants import (ENGINE_BINARY, ENGINE_NATIVE, BIN_NONE,
+                         BIN_FACTORS)
+from ..engine import getOutputFn, unlinkOutput
+from ..service import submitJob
+from ..cache import makeStampKey
+from ..fsc import computeFsc, getFscResolution, FSC_THRESHOLD
+from ..shells import SHELLS_DIR_ENV
+from ..boxes import (getMaskBox, fitBox, isFullBox, getPadShape,
+                     cropVolume, pasteVolume, compositeVolumes)
+from ..resources import (getDims, estimateConversion, estimateFilter,
+                         estimateOutput, getPhysicalMemory, formatBytes,
+                         suggestQueueMemory, SLAB_BYTES, monitorStep,
+                         formatStats, getTotalWall)
+from ..convert import (convertMask, stageHalfMap, getStageMethod,
+                       getImageLocation, splitLocation, readVolumeStats,
+                       setVolumeStats, compactVolume, readMrcHeader,
+                       binVolume, getVolumeStats, combineHalves,
+                       STAGE_LINK,
+                       MODE_INT8, MODE_FLOAT16, MODE_FLOAT32)
 
 
 class ProtSideSplitter(ProtAnalysis3D):
@@ -44,9 +66,27 @@ class ProtSideSplitter(ProtAnalysis3D):
     _devStatus = PROD
     _possibleOutputs = {
         'outputVolume1': Volume,
-        'outputVolume2': Volume
+        'outputVolume2': Volume,
+        'outputVolume': Volume,
+        'outputLocalResolution': Volume,
+        'outputFSCs': SetOfFSCs
     }
 
+    def __init__(self, **kwargs):
+        ProtAnalysis3D.__init__(self, **kwargs)
+        # JSON dict with the resources used by each step
+        self.stepStats = String()
+        self._statsLock = threading.Lock()
+
+    @property
+    def stepsExecutionMode(self):
+        """ Conversion steps run in parallel threads, unless MPI ranks
+        are requested: those are used by the native engine itself.
+        """
+        if self.numberOfMpi.get() > 1:
+            return STEPS_SERIAL
+        return STEPS_PARALLEL
+
     def _createFilenameTemplates(self):
         """ Centralize how files are called. """
         myDict = {'half1': self._getExtraPath("half1_unfil.mrc"),
@@ -54,6 +94,9 @@ class ProtSideSplitter(ProtAnalysis3D):
                   'mask': self._getExtraPath("mask.mrc"),
                   'outHalf1Fn': self._getExtraPath('half1_unfil_sidesplitter.mrc'),
                   'outHalf2Fn': self._getExtraPath('half2_unfil_sidesplitter.mrc'),
+                  'outLocRes': self._getExtraPath('local_resolution.mrc'),
+                  'outVolume': self._getExtraPath('combined_sidesplitter.mrc'),
+                  'stepStats': self._getExtraPath('step_stats.json'),
                   }
 
         self._updateFilenamesDict(myDict)
@@ -74,64 +117,336 @@ class ProtSideSplitter(ProtAnalysis3D):
                       pointerClass="VolumeMask",
                       label='Volume mask',
                       help="Provide the mask used in 3D refinement.")
+        form.addParam('bodyMasks', params.PointerParam,
+                      allowsNull=True,
+                      pointerClass="SetOfVolumes",
+                      label='Body masks',
+                      help='Masks of the bodies of a multi-body refinement, '
+                           'instead of a single volume mask. Each body is '
+                           'cropped to its mask plus the crop margin, '
+                           'filtered with its own mask and the bodies are '
+                           'filtered concurrently. The results are then '
+                           'averaged into one pair of half-maps, weighted '
+                           'by the soft masks, so they fade out to zero '
+                           'outside all bodies.')
+        form.addParam('previewBinning', params.EnumParam,
+                      choices=['none', '2x', '4x'],
+                      default=BIN_NONE,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Preview binning',
+                      help='Bin the half-maps and the mask by this factor '
+                           '(cropping their Fourier transform) to get a '
+                           'quick low-resolution preview, e.g. to check '
+                           'the mask or the SNR weighting. The full-size '
+                           'run can then be launched from the results '
+                           'viewer of the preview.')
+        self._defineFilterParams(form, cropCondition='cropToMask or bodyMasks')
+        form.addParam('doLocalResolution', params.BooleanParam,
+                      condition='engine==%d' % ENGINE_NATIVE,
+                      default=False,
+                      label='Estimate local resolution?',
+                      help='Also output a local resolution map computed '
+                           'from the local SNR that the filter estimates '
+                           'anyway, with no extra reading of the '
+                           'half-maps. The resolution of each voxel is '
+                           'the highest frequency up to which its local '
+                           'SNR stays above the one of FSC = 0.143.')
+        form.addParam('doCombine', params.BooleanParam,
+                      default=False,
+                      label='Create the combined map?',
+                      help='Average the filtered half-maps into an output '
+                           'volume with the half-maps attached, as the '
+                           'outputs of refinement protocols.')
+        form.addParam('bfactor', params.FloatParam,
+                      condition='doCombine',
+                      default=0,
+                      label='B-factor (A^2)',
+                      help='B-factor applied to the combined map, negative '
+                           'values sharpen it. 0 means no B-factor.')
+
+        form.addParallelSection(threads=3, mpi=1)
+
+    def _defineFilterParams(self, form, cropCondition='cropToMask'):
+        """ Parameters shared by all SIDESPLITTER protocols.
+        cropCondition tells when the crop margin is used.
+        """
+        form.addParam('engine', params.EnumParam,
+                      choices=['SIDESPLITTER binary', 'native (Python)'],
+                      default=ENGINE_BINARY,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Filtering engine',
+                      help='Run the compiled SIDESPLITTER program or the '
+                           'native implementation of the local filter '
+                           'included in the plugin, which only needs '
+                           'NumPy and SciPy. The native engine can also '
+                           'distribute the volume tiles among MPI '
+                           'processes (requires mpi4py).')
+        form.addParam('useTiles', params.BooleanParam,
+                      condition='engine==%d' % ENGINE_NATIVE,
+                      default=False,
+                      label='Filter in tiles?',
+                      help='Split the volume into overlapping tiles that '
+                           'are filtered in parallel, one process per '
+                           'thread, and blended back together.')
+        form.addParam('tileSize', params.IntParam,
+                      condition='engine==%d and useTiles' % ENGINE_NATIVE,
+                      default=128,
+                      label='Tile size (px)')
+        form.addParam('tilePadding', params.IntParam,
+                      condition='engine==%d and useTiles' % ENGINE_NATIVE,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=16,
+                      label='Tile padding (px)',
+                      help='Margin filtered around each tile to avoid '
+                           'edge artefacts, half of it is used to blend '
+                           'neighbouring tiles.')
         form.addParam('doSNRWeighting', params.BooleanParam,
                       expertLevel=params.LEVEL_ADVANCED,
                       default=False,
                       label='Use SNR-weighted spectrum',
                       help='Outputs the SNR weighted spectrum rather '
                            'than matching input spectrum / grey-scale.')
-
-        form.addParallelSection(threads=1, mpi=0)
+        form.addParam('cropToMask', params.BooleanParam,
+                      default=False,
+                      label='Crop to the mask?',
+                      help='Filter only the region of the box covered by '
+                           'the mask plus a margin, rounded to a size '
+                           'with fast FFTs, and paste the result back into '
+                           'the original box, zero outside. This is much '
+                           'faster for small or elongated particles in '
+                           'large boxes. Ignored if no mask is given.')
+        form.addParam('cropMargin', params.IntParam,
+                      condition=cropCondition,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=16,
+                      label='Crop margin (px)',
+                      help='Voxels kept around the mask (or around the '
+                           'mask of each body). The outer half of the '
+                           'margin is used to fade the filtered maps out '
+                           'to zero.')
+        form.addParam('fastFFTSize', params.BooleanParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=True,
+                      label='Pad to a fast FFT size?',
+                      help='Box sizes with large prime factors (e.g. 242 '
+                           '= 2 x 11 x 11) make the Fourier transforms '
+                           'much slower than close sizes. If set, the '
+                           'half-maps are padded with zeros to the next '
+                           'even size whose only factors are 2, 3, 5 and 7, '
+                           'and the filtered maps cropped back. Run '
+                           '"python -m sidesplitter.benchmark --fft-sizes" '
+                           'to compare sizes on your machine.')
+        form.addParam('useCache', params.BooleanParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=True,
+                      label='Reuse converted inputs and results?',
+                      help='Keep converted half-maps, masks and filtered '
+                           'half-maps in a project-level cache and reuse '
+                           'them in other runs (or when this run is '
+                           'restarted) with the same inputs and '
+                           'parameters. The cache location and size are '
+                           'set by SIDESPLITTER_CACHE and '
+                           'SIDESPLITTER_CACHE_SIZE (GB) variables.')
+        form.addParam('compactInputs', params.BooleanParam,
+                      condition='engine==%d' % ENGINE_NATIVE,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=False,
+                      label='Stage inputs in compact formats?',
+                      help='Half-maps that need to be converted are '
+                           'stored as float16 MRC (mode 12) and the mask '
+                           'as int8 MRC, halving and quartering the space '
+                           'they take. Only the native engine reads these '
+                           'formats. Float16 keeps about 3 significant '
+                           'digits, which is usually below the noise of '
+                           'the half-maps.')
+        form.addParam('compactOutputs', params.BooleanParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=False,
+                      label='Store filtered maps as float16?',
+                      help='Save the filtered half-maps as float16 MRC '
+                           '(mode 12), half the size of float32. Make sure '
+                           'that the programs using them can read this '
+                           'MRC mode.')
+        form.addParam('cleanIntermediates', params.BooleanParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=True,
+                      label='Delete staged inputs at the end?',
+                      help='Remove the converted half-maps and mask from '
+                           'the extra folder once the outputs have been '
+                           'registered. They are staged again if the '
+                           'filter needs to be run again.')
 
     # --------------------------- INSERT steps functions ----------------------
     
     def _insertAllSteps(self):
         self._createFilenameTemplates()
-        self._insertFunctionStep('convertInputStep')
-        self._insertFunctionStep('runSideSplitterStep')
-        self._insertFunctionStep('createOutputStep')
+        # Steps get the fingerprint of the inputs as argument, so that
+        # they are only re-executed on continue if the inputs changed.
+        # The storage of the outputs is not part of it, cached outputs
+        # are the same, but changing it re-creates the outputs.
+        fingerprint = self._getFingerprint()
+        compact = self.compactOutputs.get()
+        convertSteps = [
+            self._insertFunctionStep('convertHalfStep', half, fingerprint,
+                                     prerequisites=[])
+            for half in [1, 2]]
+        if self.mask.hasValue():
+            convertSteps.append(self._insertFunctionStep('convertMaskStep',
+                                                         fingerprint,
+                                                         prerequisites=[]))
+        if self._hasBodies():
+            bodySteps = [
+                self._insertFunctionStep('runBodyStep', i, fingerprint,
+                                         prerequisites=convertSteps)
+                for i in range(len(self._getBodyMasks()))]
+            runId = self._insertFunctionStep('compositeBodiesStep',
+                                             fingerprint, compact,
+                                             prerequisites=bodySteps)
+        else:
+            runId = self._insertFunctionStep('runSideSplitterStep',
+                                             fingerprint, compact,
+                                             prerequisites=convertSteps)
+        statsSteps = [
+            self._insertFunctionStep('computeStatsStep', half, fingerprint,
+                                     compact, prerequisites=[runId])
+            for half in [1, 2]]
+        if self.doCombine:
+            statsSteps.append(
+                self._insertFunctionStep('combineStep', fingerprint,
+                                         self.bfactor.get(),
+                                         prerequisites=statsSteps[:]))
+        self._insertFunctionStep('createOutputStep', prerequisites=statsSteps)
 
     # --------------------------- STEPS functions -----------------------------
     
-    def convertInputStep(self):
-        """ Convert input half-maps to mrc as expected by SIDESPLITTER."""
-        protRef = self.protRefine.get()
-        outVol = protRef.outputVolume
-        dim = outVol.getXDim()
-        vols = outVol.getHalfMaps().split(',')
-        ih = ImageHandler()
+    @monitorStep
+    def convertHalfStep(self, half, fingerprint):
+        """ Convert an input half-map to mrc as expected by SIDESPLITTER.
+        Half-maps that are already float32 MRC files are linked
+        instead of copied. Nothing is done if the filtered maps for
+        these inputs are already in the cache.
+        """
+        if not self._hasCachedResult(fingerprint):
+            self._stageInputHalf(half)
 
-        if self.mask.hasValue():
-            convertMask(self.mask.get(), self._getFileName('mask'), newDim=dim)
+    @monitorStep
+    def convertMaskStep(self, fingerprint):
+        """ Convert the mask to the box size of the half-maps. """
+        if not self._hasCachedResult(fingerprint):
+            self._stageInputMask()
 
-        for vol, key in zip(vols, ['half1', 'half2']):
-            ih.convert(vol, self._getFileName(key))
+    @monitorStep
+    def runSideSplitterStep(self, fingerprint, compact):
+        """ Call SIDESPLITTER with the appropriate parameters, or reuse
+        the filtered maps of a previous execution with the same
+        fingerprint. compact is the output storage applied later by
+        computeStatsStep.
+        """
+        outputs = self._getCachedOutputs(fingerprint)
+        if self.useCache:
+            cache = Plugin.getCache()
+            if all(cache.fetch(k, fn) for k, fn in outputs):
+                self.info("Reused filtered maps of a previous execution "
+                          "with fingerprint %s" % fingerprint)
+                return
+        # Outputs of a previous execution may be linked in the cache
+        for _, fn in outputs:
+            unlinkOutput(fn)
 
-    def runSideSplitterStep(self):
-        """ Call SIDESPLITTER with the appropriate parameters. """
-        args = self._getArgs()
-        param = ' '.join(['%s %s' % (k, str(v)) for k, v in args.items()])
-        program = Plugin.getProgram()
-        cmd = 'export OMP_NUM_THREADS=%d; ' % self.numberOfThreads.get()
-        cmd += program
+        # Inputs were not staged if the cached maps have been evicted since
+        for half in [1, 2]:
+            if not os.path.exists(self._getFileName('half%d' % half)):
+                self._stageInputHalf(half)
+        if (self.mask.hasValue() and
+                not os.path.exists(self._getFileName('mask'))):
+            self._stageInputMask()
 
-        self.runJob(cmd, param, env=Plugin.getEnviron(),
-                    cwd=self._getExtraPath(),
-                    numberOfThreads=1)
+        self._filterInDir(self._getFilterArgs(), self._getExtraPath(),
+                          self.numberOfThreads.get(), self.numberOfMpi.get())
 
-    def createOutputStep(self):
-        inputVol = self.protRefine.get().outputVolume
-        ps = inputVol.getSamplingRate()
+        if self.useCache:
+            for key, fn in outputs:
+                cache.store(key, fn)
 
-        vol = Volume()
-        vol.setSamplingRate(ps)
-        vol.setObjLabel('Filtered half-map 1')
-        vol.setFileName(self._getFileName('outHalf1Fn'))
+    @monitorStep
+    def runBodyStep(self, i, fingerprint):
+        """ Filter the region of the i-th body with its own mask. """
+        if not self._hasCachedResult(fingerprint):
+            self._filterBody(i)
+
+    @monitorStep
+    def compositeBodiesStep(self, fingerprint, compact):
+        """ Average the filtered bodies into the output half-maps,
+        weighted by their masks, or reuse the maps of a previous
+        execution with the same fingerprint.
+        """
+        outputs = self._getCachedOutputs(fingerprint)
+        if self.useCache:
+            cache = Plugin.getCache()
+            if all(cache.fetch(k, fn) for k, fn in outputs):
+                self.info("Reused filtered maps of a previous execution "
+                          "with fingerprint %s" % fingerprint)
+                return
+        # Outputs of a previous execution may be linked in the cache
+        for _, fn in outputs:
+            unlinkOutput(fn)
+
+        bodies = range(len(self._getBodyMasks()))
+        boxes = []
+        for i in bodies:
+            # Bodies were not filtered if the cached maps have been
+            # evicted since
+            if not os.path.exists(self._getBodyFn(i, 'box')):
+                self._filterBody(i)
+            with open(self._getBodyFn(i, 'box')) as f:
+                boxInfo = json.load(f)
+            boxes.append(boxInfo['box'])
+
+        keys = ['outHalf1Fn', 'outHalf2Fn']
+        if self._doLocalResolution():
+            keys.append('outLocRes')
+        for key in keys:
+            # Local resolution values are averaged, never faded out
+            compositeVolumes([self._getBodyFn(i, key) for i in bodies],
+                             [self._getBodyFn(i, 'mask') for i in bodies],
+                             self._getFileName(key), boxInfo['shape'],
+                             boxes, fade=key != 'outLocRes')
+        for i in bodies:
+            shutil.rmtree(self._getBodyFn(i))
+
+        if self.useCache:
+            for key, fn in outputs:
+                cache.store(key, fn)
 
-        vol2 = Volume()
-        vol2.setSamplingRate(ps)
-        vol2.setObjLabel('Filtered half-map 2')
-        vol2.setFileName(self._getFileName('outHalf2Fn'))
+    @monitorStep
+    def computeStatsStep(self, half, fingerprint, compact):
+        """ Read a filtered half-map once to get its statistics and
+        preview, so that the output step does not need to open it.
+        """
+        self._finishOutput(self._getFileName('outHalf%dFn' % half))
+
+    @monitorStep
+    def combineStep(self, fingerprint, bfactor):
+        """ Average the filtered half-maps, applying the B-factor. """
+        outFn = self._getFileName('outVolume')
+        combineHalves(self._getFileName('outHalf1Fn'),
+                      self._getFileName('outHalf2Fn'), outFn, bfactor)
+        self._writeOutputStats(outFn)
+
+    @monitorStep
+    def createOutputStep(self):
+        inputVol = self._getInputVolume()
+        factor = self._getBinning()
+        dim = inputVol.getXDim()
+        ps = inputVol.getSamplingRate() * dim / (dim // factor)
+        label = 'Filtered half-map %d'
+        if factor > 1:
+            label = 'Preview (binned %dx) of filtered half-map %%d' % factor
+
+        vol = self._createOutputVolume(self._getFileName('outHalf1Fn'),
+                                       label % 1, ps)
+        vol2 = self._createOutputVolume(self._getFileName('outHalf2Fn'),
+                                        label % 2, ps)
 
         outputs = {'outputVolume1': vol,
                    'outputVolume2': vol2}
@@ -139,6 +454,28 @@ class ProtSideSplitter(ProtAnalysis3D):
         self._defineSourceRelation(inputVol, vol)
         self._defineSourceRelation(inputVol, vol2)
 
+        if self.doCombine:
+            label = 'Combined map' if factor == 1 else (
+                'Preview (binned %dx) of combined map' % factor)
+            combined = self._createOutputVolume(
+                self._getFileName('outVolume'), label, ps)
+            combined.setHalfMaps([vol.getFileName(), vol2.getFileName()])
+            self._defineOutputs(outputVolume=combined)
+            self._defineSourceRelation(inputVol, combined)
+
+        if self._doLocalResolution():
+            locRes = self._createOutputVolume(self._getFileName('outLocRes'),
+                                              'Local resolution', ps)
+            self._defineOutputs(outputLocalResolution=locRes)
+            self._defineSourceRelation(inputVol, locRes)
+
+        fscs = self._computeFscs(ps)
+        self._defineOutputs(outputFSCs=fscs)
+        self._defineSourceRelation(inputVol, fscs)
+
+        self._cleanIntermediates([self._getFileName(key)
+                                  for key in ['half1', 'half2', 'mask']])
+
     # --------------------------- INFO functions ------------------------------
     
     def _summary(self):
@@ -146,27 +483,575 @@ class ProtSideSplitter(ProtAnalysis3D):
 
         if hasattr(self, 'outputVolume1'):
             summary.append("Created locally filtered half-maps.")
+            if self._hasBodies():
+                summary.append("%d bodies were filtered with their own "
+                               "masks." % len(self._getBodyMasks()))
+            if hasattr(self, 'outputLocalResolution'):
+                stats = getVolumeStats(self.outputLocalResolution)
+                if stats:
+                    summary.append("Local resolution: %0.2f - %0.2f A."
+                                   % (stats['min'], stats['max']))
+            if hasattr(self, 'outputFSCs'):
+                for fsc in self.outputFSCs:
+                    freqs, values = fsc.getData()
+                    summary.append("%s: FSC=%0.3f at %0.2f A."
+                                   % (fsc.getObjLabel(), FSC_THRESHOLD,
+                                      getFscResolution(freqs, values)))
+            if self._isPreview():
+                summary.append("This is a preview binned %dx, the "
+                               "full-size run can be launched from the "
+                               "results viewer." % self._getBinning())
         else:
             summary.append("Output is not ready")
+        summary.extend(self._summaryStats())
 
         return summary
+
+    def _methods(self):
+        methods = []
+
+        if hasattr(self, 'outputVolume1'):
+            methods.append("Half-maps were locally filtered with "
+                           "SIDESPLITTER [Ramlaul2020].")
+            if self._hasBodies():
+                methods.append("Each of the %d bodies was filtered "
+                               "separately with its own mask, and the "
+                               "results were averaged weighted by the "
+                               "masks." % len(self._getBodyMasks()))
+            if hasattr(self, 'outputVolume'):
+                methods.append("Filtered half-maps were averaged%s."
+                               % (" and a B-factor of %0.1f A^2 applied"
+                                  % self.bfactor.get()
+                                  if self.bfactor.get() else ""))
+            if hasattr(self, 'outputLocalResolution'):
+                methods.append("The local resolution was estimated from "
+                               "the local SNR computed by the filter, "
+                               "using a FSC threshold of 0.143.")
+            if self._isPreview():
+                methods.append("Half-maps and mask were binned %dx by "
+                               "Fourier cropping before filtering."
+                               % self._getBinning())
+            stats = self._getStepStats()
+            if stats:
+                methods.append("Processing took %0.1f s of wall time and "
+                               "%0.1f s of CPU time."
+                               % (getTotalWall(stats),
+                                  sum(s['cpu'] for s in stats.values())))
+
+        return methods
     
     def _validate(self):
-        errors = []
+        errors = self._validateFilter()
+
+        if self.engine == ENGINE_BINARY and self.numberOfMpi > 1:
+            errors.append("MPI is only supported by the native engine.")
+
+        if self.mask.hasValue() and self._hasBodies():
+            errors.append("Provide either a volume mask or body masks, "
+                          "not both.")
+
+        peak = self._getPeakMemory()
+        if (peak and not self.useQueue() and
+                peak > getPhysicalMemory()):
+            errors.append("This job needs about %s of memory but this "
+                          "host only has %s. Submit it to a queue "
+                          "requesting at least %d GB or use the native "
+                          "engine in tiles."
+                          % (formatBytes(peak),
+                             formatBytes(getPhysicalMemory()),
+                             suggestQueueMemory(peak)))
 
         return errors
+
+    def _warnings(self):
+        warnings = []
+        peak = self._getPeakMemory()
+
+        if peak and self.useQueue():
+            warnings.append("This job needs about %s of memory, request "
+                            "at least %d GB from the queue."
+                            % (formatBytes(peak), suggestQueueMemory(peak)))
+        elif peak and peak > 0.8 * getPhysicalMemory():
+            warnings.append("This job needs about %s of memory, close to "
+                            "the %s available on this host."
+                            % (formatBytes(peak),
+                               formatBytes(getPhysicalMemory())))
+
+        return warnings
     
     # --------------------------- UTILS functions -----------------------------
  
-    def _getArgs(self):
+    def _getStepStats(self):
+        """ Return the dict of resources used by each finished step. """
+        if not self.stepStats.hasValue():
+            return {}
+        return json.loads(self.stepStats.get())
+
+    def _recordStepStats(self, stepName, stats):
+        """ Persist the resources used by a step with the protocol and
+        export all of them to a JSON file.
+        """
+        with self._statsLock:
+            allStats = self._getStepStats()
+            allStats[stepName] = stats
+            self.stepStats.set(json.dumps(allStats))
+            self._store(self.stepStats)
+            with open(self._getFileName('stepStats'), 'w') as f:
+                json.dump(allStats, f, indent=2)
+
+    def _summaryStats(self):
+        """ Summary lines with the resources used by each step. """
+        return ["%s: %s" % (name, formatStats(stats))
+                for name, stats in self._getStepStats().items()]
+
+    def _validateFilter(self):
+        """ Check the parameters shared by all SIDESPLITTER protocols. """
+        errors = []
+
+        if self.engine == ENGINE_NATIVE and self.useTiles:
+            if self.tileSize <= 2 * self.tilePadding:
+                errors.append("Tile size must be larger than twice the "
+                              "tile padding.")
+
+        if (self.engine == ENGINE_BINARY and
+                not os.path.exists(Plugin.getProgram())):
+            errors.append("SIDESPLITTER binary was not found at %s, "
+                          "install it or use the native engine."
+                          % Plugin.getProgram())
+
+        return errors
+
+    def _estimateMemory(self):
+        """ Estimate the peak memory of each stage from the box size
+        read in the half-map headers.
+        """
+        halves = self._getInputVolume().getHalfMaps().split(',')
+        fullDims = getDims(halves[0])
+        conversion = sum(estimateConversion(h, fullDims) for h in halves)
+        if self.mask.hasValue():
+            conversion += 2 * SLAB_BYTES
+        tiles = self.engine == ENGINE_NATIVE and self.useTiles
+        dims = tuple(d // self._getBinning() for d in fullDims)
+
+        return {
+            'conversion': conversion,
+            'filter': estimateFilter(dims, self.engine.get(),
+                                     self.mask.hasValue(),
+                                     self.numberOfThreads.get(),
+                                     self.numberOfMpi.get(),
+                                     self.tileSize.get() if tiles else 0,
+                                     self.tilePadding.get() if tiles else 0,
+                                     self._doLocalResolution()),
+            'output': estimateOutput(dims, fsc=True,
+                                     useMask=self.mask.hasValue())
+        }
+
+    def _getPeakMemory(self):
+        """ Return the estimated peak memory or None if the input
+        half-maps are not available yet.
+        """
+        if not self.protRefine.hasValue():
+            return None
+        vol = getattr(self.protRefine.get(), 'outputVolume', None)
+        if vol is None or not vol.hasHalfMaps():
+            return None
+        if not all(os.path.exists(splitLocation(h)[1])
+                   for h in vol.getHalfMaps().split(',')):
+            return None
+
+        return max(self._estimateMemory().values())
+
+    def _getFingerprint(self):
+        """ Return a short hash of the effective inputs of the filter:
+        half-map and mask contents, the engine and its arguments. The
+        contents are only read when the cache is used, otherwise the
+        path, size and modification time of the inputs are hashed.
+        """
+        inputFns = [splitLocation(h)[1] for h in
+                    self._getInputVolume().getHalfMaps().split(',')]
+        if self.mask.hasValue():
+            maskLoc = getImageLocation(self.mask.get().getLocation())
+            inputFns.append(splitLocation(maskLoc)[1])
+        for body in self._getBodyMasks():
+            bodyLoc = getImageLocation(body.getLocation())
+            inputFns.append(splitLocation(bodyLoc)[1])
+        args = self._getFilterArgs()
+        makeKey = Plugin.getCache().makeKey if self.useCache else makeStampKey
+        key = makeKey(inputFns, engine=self.engine.get(),
+                      args=sorted(args.items()),
+                      mode=self._getStageMode(),
+                      crop=self._getCropMargin(),
+                      bodyMargin=(self.cropMargin.get()
+                                  if self._hasBodies() else None),
+                      binning=self._getBinning(),
+                      fastFFT=self.fastFFTSize.get(),
+                      # MPI runs are always tiled
+                      mpi=self.numberOfMpi.get() > 1)
+        return key[:16]
+
+    def _hasCachedResult(self, fingerprint):
+        """ Return True if the filtered maps for fingerprint are cached. """
+        if not self.useCache or fingerprint is None:
+            return False
+        cache = Plugin.getCache()
+        return all(cache.has(key)
+                   for key, _ in self._getCachedOutputs(fingerprint))
+
+    def _getCachedOutputs(self, fingerprint):
+        """ Return the (cache key, file name) of each output of the
+        filter for the given fingerprint.
+        """
+        outputs = [('%s_half%d' % (fingerprint, i),
+                    self._getFileName('outHalf%dFn' % i)) for i in [1, 2]]
+        if self._doLocalResolution():
+            outputs.append(('%s_locres' % fingerprint,
+                            self._getFileName('outLocRes')))
+        return outputs
+
+    def _doLocalResolution(self):
+        return self.engine == ENGINE_NATIVE and self.doLocalResolution
+
+    def _getInputVolume(self):
+        """ Return the refined volume that carries the half-maps. """
+        return self.protRefine.get().outputVolume
+
+    def _hasBodies(self):
+        return self.bodyMasks.hasValue()
+
+    def _getBodyMasks(self):
+        """ Return the list of body masks, empty if there are none. """
+        if not self._hasBodies():
+            return []
+        return [vol.clone() for vol in self.bodyMasks.get()]
+
+    def _getBodyFn(self, i, key=None):
+        """ Return the folder of the i-th body or a file inside it. """
+        bodyDir = self._getExtraPath('body%03d' % (i + 1))
+        if key is None:
+            return bodyDir
+        if key == 'box':
+            return os.path.join(bodyDir, 'box.json')
+        return os.path.join(bodyDir, os.path.basename(self._getFileName(key)))
+
+    def _getBodyThreads(self):
+        """ Split the available threads among the concurrent bodies. """
+        nThreads = max(self.numberOfThreads.get(), 1)
+        nJobs = min(len(self._getBodyMasks()), max(nThreads - 1, 1))
+        return max(1, nThreads // nJobs)
+
+    def _filterBody(self, i):
+        """ Crop the half-maps to the mask of the i-th body (plus the
+        crop margin), filter them in the body folder and save the box,
+        later used to composite the bodies.
+        """
+        for half in [1, 2]:
+            if not os.path.exists(self._getFileName('half%d' % half)):
+                self._stageInputHalf(half)
+
+        bodyDir = self._getBodyFn(i)
+        os.makedirs(bodyDir, exist_ok=True)
+        maskFn = self._getBodyFn(i, 'mask')
+        fullMaskFn = os.path.splitext(maskFn)[0] + '_full.mrc'
+        dim = self._getInputVolume().getXDim() // self._getBinning()
+        self._stageMask(self._getBodyMasks()[i], fullMaskFn, dim)
+
+        shape = readMrcHeader(self._getFileName('half1'))['dims'][::-1]
+        cubic = self.engine == ENGINE_BINARY
+        box = getMaskBox(fullMaskFn, self.cropMargin.get())
+        if box is None:
+            self.info("The mask of body %d is empty, filtering the "
+                      "full box." % (i + 1))
+            box = [(0, n) for n in shape]
+        box = fitBox(box, shape, cubic)
+        padShape = getPadShape(box, cubic) if self.fastFFTSize else None
+
+        cropVolume(fullMaskFn, maskFn, box, padShape)
+        os.remove(fullMaskFn)
+        for key in ['half1', 'half2']:
+            cropVolume(self._getFileName(key), self._getBodyFn(i, key),
+                       box, padShape)
+
+        args = self._getFilterArgs()
+        args['--mask'] = os.path.basename(maskFn)
+        self._runFilter(args, bodyDir, self._getBodyThreads(),
+                        self.numberOfMpi.get())
+        with open(self._getBodyFn(i, 'box'), 'w') as f:
+            json.dump({'box': box, 'shape': shape}, f)
+
+    def _getBinning(self):
+        """ Binning factor of the preview, 1 for full-size runs. """
+        return BIN_FACTORS[self.previewBinning.get()]
+
+    def _isPreview(self):
+        return self._getBinning() > 1
+
+    def _stageInputHalf(self, half):
+        vols = self._getInputVolume().getHalfMaps().split(',')
+        outFn = self._getFileName('half%d' % half)
+        if not self._isPreview():
+            self._stageHalfMap(vols[half - 1], outFn)
+            return
+
+        # outFn may still be a link to the input half-map left by a
+        # full-size run, so it is replaced and never written in place
+        fullFn = os.path.splitext(outFn)[0] + '_full.mrc'
+        self._stageHalfMap(vols[half - 1], fullFn)
+        binVolume(fullFn, outFn + '.tmp', self._getBinning())
+        os.replace(outFn + '.tmp', outFn)
+        os.remove(fullFn)
+
+    def _stageInputMask(self):
+        dim = self._getInputVolume().getXDim() // self._getBinning()
+        self._stageMask(self.mask.get(), self._getFileName('mask'), dim)
+
+    def _computeFscs(self, samplingRate):
+        """ Return a SetOfFSCs with the FSC of the input and of the
+        filtered half-maps, with and without the mask, at the given
+        sampling rate of the staged maps. Inputs that were not staged
+        because the filtered maps came from the cache are staged now.
+        """
+        inputFns = [self._getFileName('half%d' % i) for i in [1, 2]]
+        for half, fn in enumerate(inputFns, 1):
+            if not os.path.exists(fn):
+                self._stageInputHalf(half)
+        maskFn = None
+        if self.mask.hasValue():
+            maskFn = self._getFileName('mask')
+            if not os.path.exists(maskFn):
+                self._stageInputMask()
+
+        outputFns = [self._getFileName('outHalf%dFn' % i) for i in [1, 2]]
+        fscSet = self._createSetOfFSCs()
+        for label, (fn1, fn2) in [('Input half-maps', inputFns),
+                                  ('Filtered half-maps', outputFns)]:
+            freqs, fsc, maskedFsc = computeFsc(fn1, fn2, maskFn,
+                                               Plugin.getShellsDir(),
+                                               samplingRate)
+            curves = [(label, fsc)]
+            if maskedFsc is not None:
+                curves.append(('%s (masked)' % label, maskedFsc))
+            for curveLabel, values in curves:
+                fscObj = FSC(objLabel=curveLabel)
+                fscObj.setData(freqs.tolist(), values.tolist())
+                fscSet.append(fscObj)
+
+        return fscSet
+
+    def _getStageMode(self):
+        """ MRC mode of the staged half-maps. """
+        if self.engine == ENGINE_NATIVE and self.compactInputs:
+            return MODE_FLOAT16
+        return MODE_FLOAT32
+
+    def _getMaskMode(self):
+        """ MRC mode of the staged mask. """
+        if self.engine == ENGINE_NATIVE and self.compactInputs:
+            return MODE_INT8
+        return MODE_FLOAT32
+
+    def _stageHalfMap(self, location, outFn):
+        """ Stage one half-map at outFn, going through the cache
+        when it has to be converted.
+        """
+        mode = self._getStageMode()
+        if getStageMethod(location, mode) == STAGE_LINK:
+            stageHalfMap(location, outFn, mode)
+        else:
+            self._convertWithCache(location, outFn,
+                                   lambda: stageHalfMap(location, outFn,
+                                                        mode),
+                                   op='half', mode=mode)
+        self.info("Staged %s as %s" % (location, outFn))
+
+    def _stageMask(self, mask, outFn, dim):
+        """ Convert a VolumeMask to a [0, 1] MRC mask of box size dim. """
+        mode = self._getMaskMode()
+        self._convertWithCache(getImageLocation(mask.getLocation()), outFn,
+                               lambda: convertMask(mask, outFn, newDim=dim,
+                                                   mode=mode),
+                               op='mask', newDim=dim, mode=mode)
+
+    def _cleanIntermediates(self, fns):
+        """ Delete the staged inputs fns, if requested. """
+        if not self.cleanIntermediates:
+            return
+        for fn in fns:
+            if os.path.exists(fn):
+                os.remove(fn)
+                self.info("Deleted intermediate file %s" % fn)
+
+    def _getStatsFn(self, fn):
+        return os.path.splitext(fn)[0] + '_stats.json'
+
+    def _writeOutputStats(self, fn):
+        """ Compute the statistics and preview of an output volume
+        and save them next to it.
+        """
+        stats = readVolumeStats(fn, os.path.splitext(fn)[0] + '_preview.mrc')
+        with open(self._getStatsFn(fn), 'w') as f:
+            json.dump(stats, f, indent=2)
+        return stats
+
+    def _finishOutput(self, fn):
+        """ Apply the storage policy to a filtered map and save its
+        statistics. Compacting writes a new file, so that the copy in
+        the cache is not modified.
+        """
+        if self.compactOutputs:
+            compactVolume(fn, MODE_FLOAT16)
+        return self._writeOutputStats(fn)
+
+    def _createOutputVolume(self, fn, label, ps):
+        """ Create an output Volume carrying the statistics of fn, which
+        are computed now if computeStatsStep did not save them.
+        """
+        statsFn = self._getStatsFn(fn)
+        if os.path.exists(statsFn):
+            with open(statsFn) as f:
+                stats = json.load(f)
+        else:
+            stats = self._writeOutputStats(fn)
+
+        vol = Volume()
+        vol.setSamplingRate(ps)
+        vol.setObjLabel(label)
+        vol.setFileName(fn)
+        setVolumeStats(vol, stats)
+        return vol
+
+    def _runFilter(self, args, cwd, threads, mpi=1):
+        """ Run SIDESPLITTER inside cwd, where the input files are.
+        Native jobs without MPI are sent to the local service if it is
+        running, see sidesplitter.service.
+        """
+        if self.engine == ENGINE_NATIVE and mpi == 1:
+            argv = []
+            for k, v in args.items():
+                argv.extend([k, str(v)] if str(v).strip() else [k])
+            address = Plugin.getServiceAddress()
+            if submitJob(address, cwd, argv, threads,
+                         shellsDir=Plugin.getShellsDir()):
+                self.info("Filtered by the SIDESPLITTER service at %s"
+                          % address)
+                return
+
+        env = Plugin.getEnviron()
+        env['OMP_NUM_THREADS'] = str(threads)
+        if self.engine == ENGINE_NATIVE:
+            program = Plugin.getNativeProgram()
+            env[SHELLS_DIR_ENV] = Plugin.getShellsDir()
+            if mpi > 1:
+                args['--mpi'] = ' '
+        else:
+            program = Plugin.getProgram()
+        param = ' '.join(['%s %s' % (k, str(v)) for k, v in args.items()])
+        if self.engine == ENGINE_BINARY:
+            box = readMrcHeader(os.path.join(cwd, args['--v1']))['dims'][0]
+            # Read and updated by the binary, see fftw_wisdom.c
+            env['SIDESPLITTER_WISDOM_FILE'] = Plugin.getWisdomFile(box,
+                                                                   threads)
+
+        self.runJob(program, param, env=env, cwd=cwd,
+                    numberOfMpi=mpi, numberOfThreads=1)
+
+    def _getCropMargin(self):
+        """ Margin around the mask when cropping, None if not cropping. """
+        if self.cropToMask:
+            return self.cropMargin.get()
+        return None
+
+    def _filterInDir(self, args, cwd, threads, mpi=1):
+        """ Run the filter on the inputs in cwd, first cropping them
+        to the mask and padding them to a fast FFT size if requested.
+        Outputs are always written to cwd with the size of the inputs.
+        """
+        shape = readMrcHeader(os.path.join(cwd, args['--v1']))['dims'][::-1]
+        box = [(0, n) for n in shape]
+        # The binary only handles cubic boxes
+        cubic = self.engine == ENGINE_BINARY
+        margin = self._getCropMargin()
+
+        if margin is not None and '--mask' in args:
+            maskBox = getMaskBox(os.path.join(cwd, args['--mask']), margin)
+            if maskBox is None:
+                self.info("The mask is empty, filtering the full box.")
+            else:
+                box = fitBox(maskBox, shape, cubic)
+
+        boxShape = tuple(end - start for start, end in box)
+        padShape = getPadShape(box, cubic) if self.fastFFTSize else None
+        if padShape == boxShape:
+            padShape = None
+        if isFullBox(box, shape) and padShape is None:
+            return self._runFilter(args, cwd, threads, mpi)
+
+        workDir = os.path.join(cwd, 'resized')
+        os.makedirs(workDir, exist_ok=True)
+        for key in ['--v1', '--v2', '--mask']:
+            if key in args:
+                cropVolume(os.path.join(cwd, args[key]),
+                           os.path.join(workDir, args[key]), box, padShape)
+        self.info("Filtering a %s box instead of %s."
+                  % ('x'.join(map(str, (padShape or boxShape)[::-1])),
+                     'x'.join(map(str, shape[::-1]))))
+
+        self._runFilter(args, workDir, threads, mpi)
+
+        for key in ['--v1', '--v2']:
+            outFn = getOutputFn(args[key])
+            pasteVolume(os.path.join(workDir, outFn),
+                        os.path.join(cwd, outFn), shape, box,
+                        taper=(margin or 0) // 2)
+        if '--locres' in args:
+            # Zero, i.e. not estimated, outside the box
+            pasteVolume(os.path.join(workDir, args['--locres']),
+                        os.path.join(cwd, args['--locres']), shape, box)
+        shutil.rmtree(workDir)
+
+    def _convertWithCache(self, location, outFn, convertFunc, **kwargs):
+        """ Get outFn from the conversion cache or run convertFunc
+        and store its result there.
+        """
+        if not self.useCache:
+            convertFunc()
+            return
+
+        cache = Plugin.getCache()
+        index, path = splitLocation(location)
+        key = cache.makeKey([path], index=index, **kwargs)
+
+        if cache.fetch(key, outFn):
+            self.info("Reused cached conversion of %s" % location)
+        else:
+            convertFunc()
+            cache.store(key, outFn)
+
+    def _getFilterArgs(self):
+        """ Arguments of the filter of this protocol, which can also
+        write the local resolution map.
+        """
+        args = self._getArgs()
+        if self._doLocalResolution():
+            args['--locres'] = os.path.basename(
+                self._getFileName('outLocRes'))
+        return args
+
+    def _getArgs(self, useMask=None):
         """ Prepare the args dictionary."""
         args = {'--v1': os.path.basename(self._getFileName('half1')),
                 '--v2': os.path.basename(self._getFileName('half2'))}
 
-        if self.mask.hasValue():
+        if useMask is None:
+            useMask = self.mask.hasValue()
+
+        if useMask:
             args['--mask'] = os.path.basename(self._getFileName('mask'))
 
         if self.doSNRWeighting:
             args['--spectrum'] = ' '
 
+        if self.engine == ENGINE_NATIVE and self.useTiles:
+            args['--tile'] = self.tileSize.get()
+            args['--pad'] = self.tilePadding.get()
+
         return args
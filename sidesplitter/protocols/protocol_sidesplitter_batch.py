@@ -0,0 +1,281 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import BETA
+from pyworkflow.protocol.constants import STEPS_PARALLEL
+from pwem.objects import SetOfVolumes
+
+from ..constants import ENGINE_NATIVE
+from ..convert import splitLocation, SLAB_BYTES
+from ..resources import (monitorStep, getDims, estimateConversion,
+                         estimateFilter, estimateOutput)
+from .protocol_sidesplitter import ProtSideSplitter
+
+
+class ProtSideSplitterBatch(ProtSideSplitter):
+    """
+    Protocol for mitigating local over-fitting by filtering many maps
+    in a single run. The half-maps of several refinement protocols or
+    of a set of volumes are filtered concurrently, each job in its
+    own folder.
+    """
+    _label = 'local filter (batch)'
+    _devStatus = BETA
+    _possibleOutputs = {
+        'outputVolumes1': SetOfVolumes,
+        'outputVolumes2': SetOfVolumes
+    }
+    # MPI ranks run whole jobs here, each job uses threads only
+    stepsExecutionMode = STEPS_PARALLEL
+
+    INPUT_PROTOCOLS = 0
+    INPUT_VOLUMES = 1
+
+    # --------------------------- DEFINE param functions ----------------------
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputType', params.EnumParam,
+                      choices=['refinement protocols', 'set of volumes'],
+                      default=self.INPUT_PROTOCOLS,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Input type')
+        form.addParam('inputProtocols', params.MultiPointerParam,
+                      important=True,
+                      condition='inputType==%d' % self.INPUT_PROTOCOLS,
+                      pointerClass="ProtRefine3D",
+                      label='Refinement protocols',
+                      help='Select gold-standard refinement protocols, '
+                           'the half-maps of each output volume will be '
+                           'filtered.')
+        form.addParam('inputVolumes', params.PointerParam,
+                      important=True,
+                      condition='inputType==%d' % self.INPUT_VOLUMES,
+                      pointerClass="SetOfVolumes",
+                      label='Input volumes',
+                      help='Every volume in the set must have half-maps '
+                           'associated.')
+        form.addParam('inputMasks', params.MultiPointerParam,
+                      allowsNull=True,
+                      pointerClass="VolumeMask",
+                      label='Volume masks',
+                      help='Provide either a single mask used for all '
+                           'maps or one mask per input map, in the same '
+                           'order as the inputs.')
+        self._defineFilterParams(form)
+
+        form.addParallelSection(threads=4, mpi=1)
+
+    # --------------------------- INSERT steps functions ----------------------
+
+    def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        runSteps = []
+        for i in range(len(self._getItems())):
+            convertId = self._insertFunctionStep('convertItemStep', i,
+                                                 prerequisites=[])
+            runId = self._insertFunctionStep('runItemStep', i,
+                                             prerequisites=[convertId])
+            runSteps.append(runId)
+        self._insertFunctionStep('createOutputStep',
+                                 prerequisites=runSteps)
+
+    # --------------------------- STEPS functions -----------------------------
+
+    @monitorStep
+    def convertItemStep(self, i):
+        """ Stage the half-maps and the mask of the i-th input map. """
+        vol, mask = self._getItems()[i]
+        os.makedirs(self._getItemFn(i), exist_ok=True)
+
+        if mask is not None:
+            self._stageMask(mask, self._getItemFn(i, 'mask'), vol.getXDim())
+
+        for half, key in zip(vol.getHalfMaps().split(','), ['half1', 'half2']):
+            self._stageHalfMap(half, self._getItemFn(i, key))
+
+    @monitorStep
+    def runItemStep(self, i):
+        """ Filter the i-th input map. """
+        mask = self._getItems()[i][1]
+        self._filterInDir(self._getArgs(useMask=mask is not None),
+                          self._getItemFn(i), self._getJobThreads())
+        for key in ['outHalf1Fn', 'outHalf2Fn']:
+            self._finishOutput(self._getItemFn(i, key))
+
+    @monitorStep
+    def createOutputStep(self):
+        items = self._getItems()
+        volSet1 = self._createSetOfVolumes(suffix='1')
+        volSet2 = self._createSetOfVolumes(suffix='2')
+        volSet1.setSamplingRate(items[0][0].getSamplingRate())
+        volSet2.setSamplingRate(items[0][0].getSamplingRate())
+
+        for i, (inputVol, _) in enumerate(items):
+            for volSet, key, half in [(volSet1, 'outHalf1Fn', 1),
+                                      (volSet2, 'outHalf2Fn', 2)]:
+                label = ('Filtered half-map %d (%s)' %
+                         (half, inputVol.getObjLabel() or i + 1))
+                volSet.append(self._createOutputVolume(
+                    self._getItemFn(i, key), label,
+                    inputVol.getSamplingRate()))
+
+        self._defineOutputs(outputVolumes1=volSet1, outputVolumes2=volSet2)
+
+        if self.inputType == self.INPUT_VOLUMES:
+            sources = [self.inputVolumes]
+        else:
+            sources = [p.get().outputVolume for p in self.inputProtocols]
+        for source in sources:
+            self._defineSourceRelation(source, volSet1)
+            self._defineSourceRelation(source, volSet2)
+
+        self._cleanIntermediates([self._getItemFn(i, key)
+                                  for i in range(len(items))
+                                  for key in ['half1', 'half2', 'mask']])
+
+    # --------------------------- INFO functions ------------------------------
+
+    def _summary(self):
+        summary = []
+
+        if hasattr(self, 'outputVolumes1'):
+            summary.append("Created locally filtered half-maps for %d "
+                           "maps." % self.outputVolumes1.getSize())
+        else:
+            summary.append("Output is not ready")
+        summary.extend(self._summaryStats())
+
+        return summary
+
+    def _validate(self):
+        errors = self._validateFilter()
+        if self.inputType == self.INPUT_PROTOCOLS:
+            for i, pointer in enumerate(self.inputProtocols, 1):
+                if not self._hasOutputVolume(pointer):
+                    errors.append("Input protocol %d has no output volume "
+                                  "yet." % i)
+        items = self._getInputVolumes()
+
+        if not items:
+            errors.append("No input maps were provided.")
+        for vol in items:
+            if not vol.hasHalfMaps():
+                errors.append("Volume %s has no half-maps associated."
+                              % (vol.getObjLabel() or vol.getFileName()))
+
+        nMasks = len(self.inputMasks)
+        if nMasks > 1 and nMasks != len(items):
+            errors.append("Provide either one mask or one mask per input "
+                          "map (%d masks for %d maps)." % (nMasks, len(items)))
+
+        return errors
+
+    # --------------------------- UTILS functions -----------------------------
+
+    def _getInputVolumes(self):
+        """ Return the list of input volumes with half-maps. """
+        if self.inputType == self.INPUT_VOLUMES:
+            if not self.inputVolumes.hasValue():
+                return []
+            return [vol.clone() for vol in self.inputVolumes.get()]
+
+        vols = []
+        for pointer in self.inputProtocols:
+            if not self._hasOutputVolume(pointer):
+                continue
+            vol = pointer.get().outputVolume.clone()
+            vol.setObjLabel(pointer.get().getObjLabel())
+            vols.append(vol)
+        return vols
+
+    def _hasOutputVolume(self, pointer):
+        """ Return True if the pointed refinement has an output volume. """
+        return pointer.hasValue() and hasattr(pointer.get(), 'outputVolume')
+
+    def _getItems(self):
+        """ Return a list of (volume, mask) pairs, mask may be None. """
+        vols = self._getInputVolumes()
+        masks = [p.get() for p in self.inputMasks]
+        if len(masks) == 1:
+            masks = masks * len(vols)
+
+        return [(vol, masks[i] if masks else None)
+                for i, vol in enumerate(vols)]
+
+    def _getItemFn(self, i, key=None):
+        """ Return the folder of the i-th job or a file inside it. """
+        itemDir = self._getExtraPath('map%03d' % (i + 1))
+        if key is None:
+            return itemDir
+        return os.path.join(itemDir, os.path.basename(self._getFileName(key)))
+
+    def _getPeakMemory(self):
+        """ Return the estimated peak memory of the jobs that run at
+        the same time (the largest ones), or None if the input
+        half-maps are not available yet.
+        """
+        if (self.inputType == self.INPUT_PROTOCOLS and
+                not all(self._hasOutputVolume(p)
+                        for p in self.inputProtocols)):
+            return None
+
+        peaks = []
+        for vol, mask in self._getItems():
+            if not vol.hasHalfMaps():
+                return None
+            halves = vol.getHalfMaps().split(',')
+            if not all(os.path.exists(splitLocation(h)[1]) for h in halves):
+                return None
+            peaks.append(self._estimateItemMemory(halves, mask is not None))
+        if not peaks:
+            return None
+
+        nJobs = min(len(peaks), max(self.numberOfThreads.get() - 1, 1))
+        return sum(sorted(peaks, reverse=True)[:nJobs])
+
+    def _estimateItemMemory(self, halves, useMask):
+        """ Peak memory of the job filtering one pair of half-maps. """
+        dims = getDims(halves[0])
+        conversion = sum(estimateConversion(h, dims) for h in halves)
+        if useMask:
+            conversion += 2 * SLAB_BYTES
+        tiles = self.engine == ENGINE_NATIVE and self.useTiles
+        return max(conversion,
+                   estimateFilter(dims, self.engine.get(), useMask,
+                                  self._getJobThreads(), 1,
+                                  self.tileSize.get() if tiles else 0,
+                                  self.tilePadding.get() if tiles else 0),
+                   estimateOutput(dims))
+
+    def _getJobThreads(self):
+        """ Split the available threads among the concurrent jobs. """
+        nThreads = max(self.numberOfThreads.get(), 1)
+        nJobs = min(len(self._getItems()), max(nThreads - 1, 1))
+        return max(1, nThreads // nJobs)
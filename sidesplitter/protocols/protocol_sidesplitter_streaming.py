@@ -0,0 +1,340 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import glob
+import time
+
+import pyworkflow.protocol.params as params
+from pyworkflow.constants import BETA
+from pyworkflow.object import Set
+from pyworkflow.protocol import getUpdatedProtocol
+from pyworkflow.protocol.constants import STEPS_PARALLEL, STATUS_NEW
+from pwem.objects import SetOfVolumes
+
+from ..convert import readMrcHeader
+from ..resources import monitorStep
+from .protocol_sidesplitter import ProtSideSplitter
+
+
+class ProtSideSplitterStreaming(ProtSideSplitter):
+    """
+    Protocol for mitigating local over-fitting by filtering the
+    half-maps of a refinement while it is running. Every new pair of
+    half-maps written by the refinement is filtered and appended to
+    the output sets. When filtering falls behind, superseded
+    iterations are skipped.
+    """
+    _label = 'local filter (streaming)'
+    _devStatus = BETA
+    _possibleOutputs = {
+        'outputVolumes1': SetOfVolumes,
+        'outputVolumes2': SetOfVolumes
+    }
+    stepsExecutionMode = STEPS_PARALLEL
+
+    def __init__(self, **kwargs):
+        ProtSideSplitter.__init__(self, **kwargs)
+        self._stepsCheckSecs = 30
+
+    # --------------------------- DEFINE param functions ----------------------
+
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('protRefine', params.PointerParam,
+                      important=True,
+                      pointerClass="ProtRefine3D",
+                      label='Select a refinement protocol',
+                      help='Select a gold-standard refinement protocol, '
+                           'it does not need to be finished.')
+        form.addParam('filesPattern', params.StringParam,
+                      default='*_half1_*.mrc',
+                      label='Half-map 1 files pattern',
+                      help='Pattern of the first half-map files, relative '
+                           'to the extra folder of the refinement or '
+                           'absolute. The second half-map must have the '
+                           'same name with "half1" replaced by "half2".')
+        form.addParam('half1Tag', params.StringParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default='half1',
+                      label='Half-map 1 tag')
+        form.addParam('half2Tag', params.StringParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default='half2',
+                      label='Half-map 2 tag')
+        form.addParam('fileDelay', params.IntParam,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      default=30,
+                      label='File delay (s)',
+                      help='Half-maps are only processed once they have '
+                           'not been modified for this time.')
+        form.addParam('maxJobs', params.IntParam,
+                      default=1,
+                      label='Concurrent jobs',
+                      help='Maximum number of half-map pairs filtered at '
+                           'the same time. When more pairs are waiting, '
+                           'only the most recent ones are filtered.')
+        form.addParam('mask', params.PointerParam,
+                      allowsNull=True,
+                      pointerClass="VolumeMask",
+                      label='Volume mask',
+                      help="Provide the mask used in 3D refinement.")
+        self._defineFilterParams(form)
+
+        form.addParallelSection(threads=3, mpi=1)
+
+    # --------------------------- INSERT steps functions ----------------------
+
+    def _insertAllSteps(self):
+        self._createFilenameTemplates()
+        # Pairs already handled, either filtered or skipped. On continue
+        # the filtered ones are rebuilt from their DONE markers and the
+        # output sets, pairs interrupted while filtering are filtered again
+        self._seenPairs = (set(self._getDonePairs()) |
+                           self._getRegisteredPairs())
+        self._filterSteps = {}
+        self._insertFunctionStep('createOutputStep', prerequisites=[],
+                                 wait=True)
+
+    def _stepsCheck(self):
+        self._checkNewInput()
+        self._checkNewOutput()
+
+    def _checkNewInput(self):
+        """ Insert filter steps for the newest pairs of half-maps. If
+        no job slot is free, the newest pair stays queued until the next
+        check, while older pending pairs are skipped as superseded.
+        """
+        pairs = [p for p in self._findPairs() if p[0] not in self._seenPairs]
+        if not pairs:
+            return
+
+        free = max(self.maxJobs.get() - len(self._getRunningPairs()), 0)
+        newSteps = []
+        # Pairs are sorted by age, the most recent ones are kept
+        for i, (key, half1, half2) in enumerate(reversed(pairs)):
+            if i < free:
+                newSteps.append(self._insertFunctionStep(
+                    'filterPairStep', key, half1, half2, prerequisites=[]))
+                self._filterSteps[key] = newSteps[-1]
+            elif i == 0:
+                # Queued, not seen yet
+                continue
+            else:
+                self.info("Skipping superseded half-maps %s" % half1)
+            self._seenPairs.add(key)
+
+        if newSteps:
+            self.updateSteps()
+
+    def _checkNewOutput(self):
+        """ Append the filtered pairs to the output sets, and close them
+        once the refinement has finished and all jobs are done.
+        """
+        registered = self._getRegisteredPairs()
+        done = [key for key in self._getDonePairs() if key not in registered]
+
+        refinementDone = not self._isRefinementActive()
+        finished = (refinementDone and
+                    not [p for p in self._findPairs(delay=0)
+                         if p[0] not in self._seenPairs] and
+                    not self._getRunningPairs())
+        state = Set.STREAM_CLOSED if finished else Set.STREAM_OPEN
+
+        if done or finished:
+            for half in [1, 2]:
+                self._updateOutputSet('outputVolumes%d' % half, half,
+                                      sorted(done), state)
+            self._cleanIntermediates([self._getPairFn(key, fileKey)
+                                      for key in done
+                                      for fileKey in ['half1', 'half2',
+                                                      'mask']])
+
+        if finished:
+            for step in self._steps:
+                if (step.funcName.get() == 'createOutputStep' and
+                        step.isWaiting()):
+                    step.setStatus(STATUS_NEW)
+
+    # --------------------------- STEPS functions -----------------------------
+
+    @monitorStep
+    def filterPairStep(self, key, half1, half2):
+        """ Stage and filter one pair of half-maps in its own folder. """
+        pairDir = self._getPairFn(key)
+        os.makedirs(pairDir, exist_ok=True)
+
+        for half, location in [(1, half1), (2, half2)]:
+            self._stageHalfMap(location, self._getPairFn(key, 'half%d' % half))
+        if self.mask.hasValue():
+            dim = readMrcHeader(half1)['dims'][0]
+            self._stageMask(self.mask.get(), self._getPairFn(key, 'mask'), dim)
+
+        self._filterInDir(self._getArgs(), pairDir,
+                          max(self.numberOfThreads.get() // self.maxJobs.get(),
+                              1))
+        for half in [1, 2]:
+            self._finishOutput(self._getPairFn(key, 'outHalf%dFn' % half))
+        open(self._getPairFn(key, 'done'), 'w').close()
+
+    @monitorStep
+    def createOutputStep(self):
+        """ Outputs are registered while streaming. """
+        pass
+
+    # --------------------------- INFO functions ------------------------------
+
+    def _summary(self):
+        summary = []
+
+        if hasattr(self, 'outputVolumes1'):
+            summary.append("Filtered %d pairs of half-maps."
+                           % self.outputVolumes1.getSize())
+        else:
+            summary.append("Waiting for half-maps.")
+        summary.extend(self._summaryStats())
+
+        return summary
+
+    def _validate(self):
+        errors = self._validateFilter()
+
+        if self.maxJobs < 1:
+            errors.append("At least one concurrent job is needed.")
+        if self.half1Tag.get() not in self.filesPattern.get():
+            errors.append("The files pattern must contain the half-map 1 "
+                          "tag (%s)." % self.half1Tag.get())
+
+        return errors
+
+    def _warnings(self):
+        return []
+
+    # --------------------------- UTILS functions -----------------------------
+
+    def _getPairFn(self, key, fileKey=None):
+        """ Return the folder of a pair or a file inside it. """
+        pairDir = self._getExtraPath(key)
+        if fileKey is None:
+            return pairDir
+        if fileKey == 'done':
+            return os.path.join(pairDir, 'DONE')
+        return os.path.join(pairDir,
+                            os.path.basename(self._getFileName(fileKey)))
+
+    def _findPairs(self, delay=None):
+        """ Return (key, half1, half2) for every complete pair of
+        half-maps not modified for delay seconds, oldest first.
+        """
+        delay = self.fileDelay.get() if delay is None else delay
+        pattern = self.filesPattern.get()
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(self.protRefine.get()._getExtraPath(),
+                                   pattern)
+        now = time.time()
+        pairs = []
+        for half1 in glob.glob(pattern):
+            name = os.path.basename(half1)
+            half2 = os.path.join(os.path.dirname(half1),
+                                 name.replace(self.half1Tag.get(),
+                                              self.half2Tag.get()))
+            if not os.path.exists(half2):
+                continue
+            mtime = max(os.path.getmtime(half1), os.path.getmtime(half2))
+            if now - mtime >= delay:
+                key = os.path.splitext(name)[0]
+                pairs.append((mtime, key, half1, half2))
+
+        return [p[1:] for p in sorted(pairs)]
+
+    def _isRefinementActive(self):
+        """ Status of the refinement read again from the project, the
+        object loaded when this protocol started is not updated.
+        """
+        return getUpdatedProtocol(self.protRefine.get()).isActive()
+
+    def _getDonePairs(self):
+        """ Keys of the pairs filtered so far, also by previous
+        executions.
+        """
+        return [key for key in os.listdir(self._getExtraPath())
+                if os.path.exists(self._getPairFn(key, 'done'))]
+
+    def _getRunningPairs(self):
+        """ Keys of the pairs with filter steps not finished yet. """
+        return [key for key in self._filterSteps
+                if not os.path.exists(self._getPairFn(key, 'done'))]
+
+    def _getRegisteredPairs(self):
+        """ Keys of the pairs already in the output sets. """
+        volSet = getattr(self, 'outputVolumes1', None)
+        if volSet is None:
+            return set()
+        return {os.path.basename(os.path.dirname(vol.getFileName()))
+                for vol in volSet}
+
+    def _getSamplingRate(self, halfFn):
+        """ Pixel size from the MRC header, or from the particles of
+        the refinement if it is not set.
+        """
+        header = readMrcHeader(halfFn)
+        if header and header['voxelSize'] > 0:
+            return header['voxelSize']
+        return self.protRefine.get().inputParticles.get().getSamplingRate()
+
+    def _updateOutputSet(self, outputName, half, keys, streamState):
+        """ Append the filtered half of the given pairs to an output
+        set, creating it the first time.
+        """
+        setFn = self._getPath('volumes%d.sqlite' % half)
+        firstTime = not hasattr(self, outputName)
+        if firstTime:
+            volSet = self._createSetOfVolumes(suffix=str(half))
+        else:
+            volSet = SetOfVolumes(filename=setFn)
+            volSet.loadAllProperties()
+            volSet.enableAppend()
+
+        for key in keys:
+            fn = self._getPairFn(key, 'outHalf%dFn' % half)
+            vol = self._createOutputVolume(
+                fn, 'Filtered half-map %d (%s)' % (half, key),
+                self._getSamplingRate(fn))
+            if not volSet.getSamplingRate():
+                volSet.setSamplingRate(vol.getSamplingRate())
+            volSet.append(vol)
+
+        volSet.setStreamState(streamState)
+
+        if firstTime:
+            self._defineOutputs(**{outputName: volSet})
+            self._defineSourceRelation(self.protRefine, volSet)
+        else:
+            volSet.write()
+            outputAttr = getattr(self, outputName)
+            outputAttr.copy(volSet, copyId=False)
+            self._store(outputAttr)
+        volSet.close()
@@ -0,0 +1,384 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Memory model and resource monitoring of a SIDESPLITTER run.
+
+Peak memory is estimated from the box size read from the MRC headers,
+so the inputs do not need to be loaded. Costs are expressed in number
+of float32 volumes of the full box (or of a tile) and were calibrated
+with calibrate(), which measures the peak RSS of the native engine on
+synthetic maps.
+"""
+
+import os
+import json
+import time
+import resource
+import functools
+import threading
+import multiprocessing
+
+import numpy as np
+
+from .constants import ENGINE_BINARY, ENGINE_NATIVE
+from .convert import (readMrcHeader, splitLocation, getStageMethod,
+                      STAGE_LINK, STAGE_SLABS, SLAB_BYTES)
+
+
+# Float32 volumes held at the same time by each part of the pipeline
+BINARY_VOLUMES = 10
+NATIVE_VOLUMES = 22
+MASK_VOLUMES = 1
+LOCRES_VOLUMES = 2
+CONVERT_VOLUMES = 3
+SHARED_VOLUMES = 4
+SPECTRUM_VOLUMES = 6
+# Transforms kept by the FSC of a pair of half-maps, the shell indexes
+# and the mapped inputs, and the extra ones for the masked FSC
+FSC_VOLUMES = 3
+FSC_MASK_VOLUMES = 3
+# Memory used by the Python interpreter and the imported modules
+BASE_BYTES = 100 * 1024 ** 2
+
+GB = 1024 ** 3
+
+
+def getDims(location):
+    """ Return the box dimensions of a volume reading only its header. """
+    header = readMrcHeader(splitLocation(location)[1])
+    if header is not None:
+        return header['dims']
+    from pwem.emlib.image import ImageHandler
+    return ImageHandler().getDimensions(location)[:3]
+
+
+def volumeBytes(dims):
+    return int(np.prod(dims)) * 4
+
+
+def estimateConversion(location, dims):
+    """ Peak memory needed to stage a half-map. """
+    method = getStageMethod(location)
+    if method == STAGE_LINK:
+        return 0
+    if method == STAGE_SLABS:
+        return 2 * SLAB_BYTES
+    return CONVERT_VOLUMES * volumeBytes(dims)
+
+
+def estimateFilter(dims, engine=ENGINE_BINARY, useMask=False, threads=1,
+                   mpi=1, tileSize=0, tilePadding=0, locres=False):
+    """ Peak memory of the filtering job, summed over all the
+    processes that run on the same node for a local run.
+    """
+    vol = volumeBytes(dims)
+    extra = MASK_VOLUMES if useMask else 0
+    if locres and engine == ENGINE_NATIVE:
+        extra += LOCRES_VOLUMES
+
+    if engine == ENGINE_BINARY:
+        return (BINARY_VOLUMES + extra) * vol
+
+    if not tileSize and mpi <= 1:
+        return BASE_BYTES + (NATIVE_VOLUMES + extra) * vol
+
+    tile = volumeBytes([min(tileSize or 128, d) + 2 * tilePadding
+                        for d in dims])
+    perTile = BASE_BYTES + (NATIVE_VOLUMES + extra) * tile
+    if mpi > 1:
+        # Rank 0 also matches the spectrum of the full volumes
+        return perTile * mpi + SPECTRUM_VOLUMES * vol
+    return (perTile * threads + (SHARED_VOLUMES + extra) * vol +
+            SPECTRUM_VOLUMES * vol)
+
+
+def estimateOutput(dims, fsc=False, useMask=False):
+    """ Outputs are read slab-wise when registered, but the FSC keeps
+    the Fourier transforms of both half-maps (and of the masked ones)
+    in memory.
+    """
+    if not fsc:
+        return 2 * SLAB_BYTES
+    volumes = FSC_VOLUMES + (FSC_MASK_VOLUMES if useMask else 0)
+    return volumes * volumeBytes(dims) + 2 * SLAB_BYTES
+
+
+def getPhysicalMemory():
+    """ Total memory of this host, in bytes. """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def formatBytes(nbytes):
+    return '%0.1f GB' % (nbytes / float(GB))
+
+
+def suggestQueueMemory(peak):
+    """ Memory to request from the queue system, in GB. """
+    return int(np.ceil(peak * 1.2 / GB))
+
+
+def _readIoCounters(path='/proc/thread-self/io'):
+    """ Bytes read from and written to storage by this thread (or the
+    process of path), or zeros if not available.
+    """
+    counters = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def _getThreadUsage():
+    """ Resource usage of the calling thread, or of the whole process
+    where RUSAGE_THREAD is not available.
+    """
+    who = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+    return resource.getrusage(who)
+
+
+def _readPeakRss(pid='self'):
+    """ Peak resident memory of a process in bytes since it started or
+    since the last _resetPeakRss, 0 if not available.
+    """
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def _resetPeakRss():
+    """ Reset the peak resident memory of this process to the current
+    one (Linux >= 4.0).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _getChildren(pid):
+    """ Process ids of the children of all threads of pid. """
+    children = []
+    try:
+        for tid in os.listdir('/proc/%s/task' % pid):
+            with open('/proc/%s/task/%s/children' % (pid, tid)) as f:
+                children.extend(f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def getTreePeakRss(pid=None):
+    """ Sum of the peak resident memory of a process and all its
+    descendants, in bytes. Memory shared between them is counted by
+    each of them.
+    """
+    pids = [str(pid or os.getpid())]
+    total = 0
+    while pids:
+        pid = pids.pop()
+        total += _readPeakRss(pid)
+        pids.extend(_getChildren(pid))
+    return total
+
+
+class StepMonitor:
+    """ Context manager measuring the wall time, CPU time, peak RSS and
+    storage I/O of a block of code, including the programs it runs.
+
+    Steps run concurrently in threads of the protocol, so the CPU time
+    and I/O done in the protocol process are those of the calling
+    thread. Programs are accounted (CPU time and storage blocks) when
+    they finish, so the programs of concurrent steps may be counted by
+    each other. The peak RSS of the protocol process is reset when the
+    step starts, and it is sampled every POLL_SECS together with the
+    peaks of its running programs, so it also includes concurrent
+    steps. Programs that finish between two samples are accounted by
+    their own peak RSS when they are waited for.
+    """
+    POLL_SECS = 0.2
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._thread = _getThreadUsage()
+        self._children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._io = _readIoCounters()
+        _resetPeakRss()
+        self._peak = getTreePeakRss()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self.stats = None
+        return self
+
+    def _sample(self):
+        while not self._done.wait(self.POLL_SECS):
+            self._peak = max(self._peak, getTreePeakRss())
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._sampler.join()
+        peak = max(self._peak, getTreePeakRss())
+        io = _readIoCounters()
+        thread = _getThreadUsage()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss of the children is a lifetime maximum, it only
+        # tells the peak of a program waited for during this step
+        # when it increased
+        if children.ru_maxrss > self._children.ru_maxrss:
+            peak = max(peak, children.ru_maxrss * 1024)
+
+        def delta(attr):
+            return (getattr(thread, attr) - getattr(self._thread, attr) +
+                    getattr(children, attr) - getattr(self._children, attr))
+
+        end = time.time()
+        self.stats = {
+            'start': self._wall,
+            'end': end,
+            'wall': end - self._wall,
+            'cpu': delta('ru_utime') + delta('ru_stime'),
+            'peak': peak,
+            # Blocks of the children are 512 bytes
+            'read': (io['read_bytes'] - self._io['read_bytes'] +
+                     (children.ru_inblock - self._children.ru_inblock) * 512),
+            'written': (io['write_bytes'] - self._io['write_bytes'] +
+                        (children.ru_oublock -
+                         self._children.ru_oublock) * 512)
+        }
+        return False
+
+
+def getTotalWall(allStats):
+    """ Wall time from the start of the first step to the end of the
+    last one, as steps may overlap. Stats saved before the start and
+    end times were recorded are added up.
+    """
+    stats = list(allStats.values())
+    if stats and all('start' in s for s in stats):
+        return (max(s['end'] for s in stats) -
+                min(s['start'] for s in stats))
+    return sum(s['wall'] for s in stats)
+
+
+def monitorStep(func):
+    """ Decorator for protocol step functions that measures each call
+    with a StepMonitor and passes the result to the protocol method
+    _recordStepStats(stepName, stats).
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        with StepMonitor() as monitor:
+            result = func(self, *args)
+        name = '%s(%s)' % (func.__name__, ', '.join(str(a) for a in args))
+        self._recordStepStats(name, monitor.stats)
+        return result
+    return wrapper
+
+
+def formatStats(stats):
+    """ One line description of the stats of a step. """
+    return ('%0.1f s wall, %0.1f s CPU, peak %s, read %s, written %s'
+            % (stats['wall'], stats['cpu'], formatBytes(stats['peak']),
+               formatBytes(stats['read']), formatBytes(stats['written'])))
+
+
+def _runMeasured(queue, func, args, kwargs):
+    wall, cpu = time.time(), time.process_time()
+    func(*args, **kwargs)
+    selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+    childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kB on Linux
+    queue.put({
+        'wall': time.time() - wall,
+        'cpu': (time.process_time() - cpu +
+                childUsage.ru_utime + childUsage.ru_stime),
+        'peak': max(selfUsage.ru_maxrss, childUsage.ru_maxrss) * 1024
+    })
+
+
+def measure(func, *args, **kwargs):
+    """ Run func(*args, **kwargs) in a fresh process and return its wall
+    time, CPU time and peak RSS, including the programs it launches.
+    func must be importable from the child process.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_runMeasured,
+                       args=(queue, func, args, kwargs))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError("Measured run of %s failed." % func.__name__)
+    return queue.get()
+
+
+def _filterRandom(n, **kwargs):
+    from .engine import LocalFilter, filterTiled
+    rng = np.random.default_rng(0)
+    half1 = rng.normal(size=(n, n, n)).astype(np.float32)
+    half2 = rng.normal(size=(n, n, n)).astype(np.float32)
+    if kwargs.get('tileSize'):
+        filterTiled(half1, half2, **kwargs)
+    else:
+        LocalFilter(half1.shape).filter(half1, half2)
+
+
+def measurePeak(n, **kwargs):
+    """ Peak RSS of the native engine filtering a n^3 box. """
+    return measure(_filterRandom, n, **kwargs)['peak']
+
+
+def calibrate(sizes=(64, 128, 192), outFn=None):
+    """ Compare the measured peak memory of the native engine with the
+    model for several box sizes, optionally saving the result as JSON.
+    """
+    results = []
+    for n in sizes:
+        measured = measurePeak(n)
+        model = estimateFilter((n, n, n), engine=ENGINE_NATIVE)
+        results.append({'box': n, 'measured': measured, 'model': model,
+                        'ratio': measured / float(model)})
+    if outFn:
+        with open(outFn, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    for row in calibrate():
+        print('%(box)4d  measured %(measured)12d  model %(model)12d  '
+              'ratio %(ratio)0.2f' % row)
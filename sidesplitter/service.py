@@ -0,0 +1,251 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Local service that runs native engine jobs in long-lived processes.
+
+Filtering many small maps (e.g. one per class) with the native engine
+spends most of the time starting Python and importing NumPy and SciPy.
+This service keeps a few worker processes alive, with the engine
+imported and the filters of the last box sizes cached, and runs the
+jobs submitted by the protocols through a Unix socket:
+
+    python -m sidesplitter.service --workers 4
+
+The protocols use the service when its socket exists (by default
+~/.sidesplitter/service.sock, see SIDESPLITTER_SERVICE) and run the
+engine as a separate program otherwise. Only processes of the same
+user can submit jobs: the socket and the key next to it are created
+with user-only permissions.
+"""
+
+import os
+import sys
+import signal
+import argparse
+import queue
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from .constants import DEFAULT_SERVICE_SOCKET
+from .shells import SHELLS_DIR_ENV
+
+
+def getKeyFn(address):
+    return address + '.key'
+
+
+def _runJob(job):
+    """ Run one engine job in the current process. """
+    from .engine import main
+    os.environ['OMP_NUM_THREADS'] = str(job['threads'])
+    serviceShellsDir = os.environ.get(SHELLS_DIR_ENV)
+    if job.get('shellsDir'):
+        os.environ[SHELLS_DIR_ENV] = job['shellsDir']
+    cwd = os.getcwd()
+    os.chdir(job['cwd'])
+    try:
+        main(job['argv'])
+    finally:
+        os.chdir(cwd)
+        if serviceShellsDir is None:
+            os.environ.pop(SHELLS_DIR_ENV, None)
+        else:
+            os.environ[SHELLS_DIR_ENV] = serviceShellsDir
+
+
+def _workerLoop(conn):
+    """ Run the jobs received on conn until None is received, sending
+    back None or the traceback of the error of each one.
+    """
+    from . import engine  # noqa: imported once for all jobs
+    # Interrupting the service stops the workers after their job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for job in iter(conn.recv, None):
+        try:
+            _runJob(job)
+            conn.send(None)
+        except BaseException:
+            conn.send(traceback.format_exc())
+
+
+class Service:
+    """ Accept jobs on a Unix socket and run them in worker processes.
+    Each connection submits one job and waits for its result.
+
+    Every worker process is driven by a thread of the service, which
+    sends it one job at a time. If the process dies while running a
+    job (e.g. killed when out of memory), the job gets an error and a
+    new process replaces it.
+    """
+    # Seconds between checks of the worker process running a job
+    POLL_SECS = 1
+
+    def __init__(self, address, workers=1):
+        self.address = address
+        self.jobs = queue.Queue()
+        self.nWorkers = workers
+
+    def _startWorker(self):
+        conn, workerConn = multiprocessing.Pipe()
+        # Workers are not daemonic so that the engine can start its
+        # own pool of processes when filtering in tiles
+        worker = multiprocessing.Process(target=_workerLoop,
+                                         args=(workerConn,))
+        worker.start()
+        workerConn.close()
+        return worker, conn
+
+    def _runWorker(self):
+        """ Send the queued jobs to a worker process, until None. """
+        worker, conn = self._startWorker()
+        for job, result, event in iter(self.jobs.get, None):
+            try:
+                conn.send(job)
+                while not conn.poll(self.POLL_SECS):
+                    if not worker.is_alive():
+                        raise EOFError
+                result.append(conn.recv())
+            except (EOFError, OSError):
+                worker.join()
+                result.append("Worker process died with exit code %s."
+                              % worker.exitcode)
+                conn.close()
+                worker, conn = self._startWorker()
+            event.set()
+
+        conn.send(None)
+        worker.join()
+
+    def _handle(self, conn):
+        with conn:
+            job = conn.recv()
+            event, result = threading.Event(), []
+            self.jobs.put((job, result, event))
+            event.wait()
+            try:
+                conn.send({'error': result[0]})
+            except OSError:
+                # The client stopped waiting (see submitJob timeout)
+                pass
+
+    def serve(self):
+        os.makedirs(os.path.dirname(self.address), mode=0o700,
+                    exist_ok=True)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        authkey = os.urandom(32)
+        keyFn = getKeyFn(self.address)
+        fd = os.open(keyFn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+
+        runners = [threading.Thread(target=self._runWorker, daemon=True)
+                   for _ in range(self.nWorkers)]
+        for runner in runners:
+            runner.start()
+
+        listener = Listener(self.address, 'AF_UNIX', authkey=authkey)
+        os.chmod(self.address, 0o600)
+        print("Serving %d workers at %s" % (self.nWorkers, self.address))
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError,
+                        multiprocessing.AuthenticationError):
+                    continue
+                threading.Thread(target=self._handle, args=(conn,),
+                                 daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.remove(keyFn)
+            for _ in runners:
+                self.jobs.put(None)
+            for runner in runners:
+                runner.join()
+
+
+def isRunning(address):
+    """ Return True if a service seems to be listening at address. """
+    return os.path.exists(address) and os.path.exists(getKeyFn(address))
+
+
+def submitJob(address, cwd, argv, threads=1, timeout=None, shellsDir=None):
+    """ Run the engine with argv inside cwd through the service at
+    address, saving the Fourier shells in shellsDir (see
+    sidesplitter.shells). Return False if the service is not running or stops
+    before answering, so that the caller can run the engine itself,
+    and raise RuntimeError if the job failed or no result arrived
+    within timeout seconds.
+    """
+    if not isRunning(address):
+        return False
+    try:
+        with open(getKeyFn(address), 'rb') as f:
+            authkey = f.read()
+        conn = Client(address, 'AF_UNIX', authkey=authkey)
+    except (OSError, EOFError, multiprocessing.AuthenticationError):
+        # Stale socket of a service that is no longer running
+        return False
+
+    with conn:
+        try:
+            conn.send({'cwd': os.path.abspath(cwd), 'argv': list(argv),
+                       'threads': threads, 'shellsDir': shellsDir})
+            if not conn.poll(timeout):
+                raise RuntimeError("No result from the SIDESPLITTER service "
+                                   "after %s seconds." % timeout)
+            result = conn.recv()
+        except (OSError, EOFError):
+            # The service was stopped while running the job
+            return False
+
+    if result['error']:
+        raise RuntimeError("Job failed in the SIDESPLITTER service:\n%s"
+                           % result['error'])
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='sidesplitter.service',
+        description='Run native SIDESPLITTER jobs in long-lived processes.')
+    parser.add_argument('--socket', default=DEFAULT_SERVICE_SOCKET,
+                        help='Unix socket to listen on (default: %s).'
+                             % DEFAULT_SERVICE_SOCKET)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of jobs run at the same time.')
+    args = parser.parse_args(argv)
+
+    Service(os.path.expanduser(args.socket), args.workers).serve()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Fourier shells of the rfft half-space of a box.
+
+The radius (in Fourier pixels) and the integer shell index of every
+rfft coefficient only depend on the box shape, and are needed by the
+local filter, the spectrum matching and the FSC. They are built once
+per shape by broadcasting the 1D frequencies, kept in memory for the
+last shapes used and, if a folder is given (or SIDESPLITTER_SHELLS_DIR
+is set), saved as .npy files that later processes memory-map instead
+of computing them again.
+
+The arrays returned are shared and read-only.
+"""
+
+import os
+import functools
+
+import numpy as np
+from scipy import fft
+
+
+# Folder with the .npy files of the shells, read by the engine processes
+SHELLS_DIR_ENV = 'SIDESPLITTER_SHELLS_DIR'
+
+
+def _computeRadius(shape):
+    """ Radius in Fourier pixels of each rfft coefficient, scaled so
+    that the smallest dimension of the box has n / 2 shells up to
+    Nyquist.
+    """
+    n = min(shape)
+    freqs = [fft.fftfreq(d) * n for d in shape[:-1]]
+    freqs.append(fft.rfftfreq(shape[-1]) * n)
+    fz, fy, fx = np.meshgrid(*freqs, indexing='ij', sparse=True)
+    return np.sqrt(fz ** 2 + fy ** 2 + fx ** 2).astype(np.float32)
+
+
+def _indexDtype(radius):
+    """ Smallest integer type holding the shell indexes. """
+    return np.int16 if radius.max() < np.iinfo(np.int16).max else np.int32
+
+
+def _save(fn, data):
+    """ Save data to fn, replacing it only once it is complete so that
+    concurrent processes never read a partial file.
+    """
+    tmpFn = '%s.%d.tmp.npy' % (os.path.splitext(fn)[0], os.getpid())
+    np.save(tmpFn, data)
+    os.replace(tmpFn, fn)
+
+
+@functools.lru_cache(maxsize=4)
+def _getShells(shape, shellsDir):
+    if shellsDir:
+        prefix = os.path.join(shellsDir,
+                              'shells_%s' % 'x'.join(map(str, shape)))
+        radiusFn, indexFn = prefix + '_radius.npy', prefix + '_index.npy'
+        if os.path.exists(radiusFn) and os.path.exists(indexFn):
+            return (np.load(radiusFn, mmap_mode='r'),
+                    np.load(indexFn, mmap_mode='r'))
+
+    radius = _computeRadius(shape)
+    index = np.rint(radius).astype(_indexDtype(radius))
+    if shellsDir:
+        os.makedirs(shellsDir, exist_ok=True)
+        _save(radiusFn, radius)
+        _save(indexFn, index)
+    for data in (radius, index):
+        data.flags.writeable = False
+    return radius, index
+
+
+def getShells(shape, shellsDir=None):
+    """ Return the (radius, index) arrays of the rfft half-space of a
+    box of the given shape (z, y, x): the float32 radius in Fourier
+    pixels and the shell index (the rounded radius) as int16, or int32
+    for huge boxes. shellsDir defaults to SIDESPLITTER_SHELLS_DIR.
+    """
+    shape = tuple(int(d) for d in shape)
+    return _getShells(shape, shellsDir or os.environ.get(SHELLS_DIR_ENV))
+
+
+def getShellRadius(shape, shellsDir=None):
+    return getShells(shape, shellsDir)[0]
+
+
+def getShellIndex(shape, shellsDir=None):
+    return getShells(shape, shellsDir)[1]
+
+
+def getNumberOfShells(shape):
+    """ Number of shells from the origin up to Nyquist. """
+    return min(shape) // 2 + 1
+
+
+def getShellFrequencies(shape, voxelSize):
+    """ Spatial frequency (1/A) of each shell up to Nyquist. """
+    return np.arange(getNumberOfShells(shape)) / (min(shape) * voxelSize)
+
+
+def getHermitianWeights(shape):
+    """ Weight of each X plane of the rfft half-space, to be broadcast
+    along the last axis: 2 for planes standing for two coefficients
+    of the full transform, 1 for X = 0 (and Nyquist for even sizes).
+    """
+    weights = np.full(shape[-1] // 2 + 1, 2, dtype=np.float32)
+    weights[0] = 1
+    if shape[-1] % 2 == 0:
+        weights[-1] = 1
+    return weights
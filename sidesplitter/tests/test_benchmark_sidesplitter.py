@@ -0,0 +1,69 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+
+from pyworkflow.utils import magentaStr
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..benchmark import runBenchmark, compare, runFFTSizes
+
+
+class TestSideSplitterBenchmark(BaseTest):
+    """ Run the benchmark suite on small synthetic maps. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_benchmark(self):
+        print(magentaStr("\n==> Running sidesplitter benchmark:"))
+        outFn = self.getOutputPath('benchmark.json')
+        report = runBenchmark([32, 48], outFn=outFn)
+
+        with open(outFn) as f:
+            saved = json.load(f)
+        self.assertEqual(saved['results'], report['results'])
+
+        stages = [(r['box'], r['stage']) for r in report['results']]
+        self.assertEqual(stages, [(n, s) for n in [32, 48]
+                                  for s in ['convert', 'filter', 'output']])
+        for row in report['results']:
+            self.assertGreater(row['peak'], 0)
+            self.assertGreaterEqual(row['wall'], 0)
+
+        rows = compare(report, report)
+        self.assertEqual(len(rows), 6)
+        for row in rows:
+            self.assertAlmostEqual(row['wall'], 1.0)
+
+    def test_fft_sizes(self):
+        print(magentaStr("\n==> Timing FFT box sizes:"))
+        rows = runFFTSizes([32, 33], repeats=1)
+        self.assertEqual([(r['box'], r['fast']) for r in rows],
+                         [(32, 32), (33, 36)])
+        self.assertEqual(rows[0]['time'], rows[0]['fastTime'])
+        for row in rows:
+            self.assertGreater(row['time'], 0)
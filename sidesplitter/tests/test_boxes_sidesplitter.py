@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..boxes import (getFastSize, isFastSize, getMaskBox, fitBox,
+                     isFullBox, getPadShape, cropVolume, pasteVolume,
+                     compositeVolumes)
+
+
+class TestSideSplitterBoxes(BaseTest):
+    """ Cropping and pasting of volumes, no input data needed. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeVolume(self, name, data):
+        fn = self.getOutputPath(name)
+        with mrcfile.new(fn, data, overwrite=True) as mrc:
+            mrc.voxel_size = 1.5
+        return fn
+
+    def _readVolume(self, fn):
+        with mrcfile.open(fn, permissive=True) as mrc:
+            return mrc.data.copy(), mrc.voxel_size.x
+
+    def test_crop_paste(self):
+        shape = (40, 48, 44)
+        rng = np.random.default_rng(0)
+        data = rng.normal(size=shape).astype(np.float32)
+        mask = np.zeros(shape, dtype=np.float32)
+        mask[10:20, 12:30, 8:25] = 1
+        volFn = self._writeVolume('vol.mrc', data)
+        maskFn = self._writeVolume('mask.mrc', mask)
+
+        box = getMaskBox(maskFn, margin=2)
+        self.assertEqual(box, [(8, 22), (10, 32), (6, 27)])
+        box = fitBox(box, shape)
+        for (start, end), n in zip(box, shape):
+            self.assertTrue(isFastSize(end - start))
+            self.assertTrue(0 <= start < end <= n)
+        inside = tuple(slice(start, end) for start, end in box)
+
+        # Small slabs to exercise the slab-wise copy
+        cropFn = cropVolume(volFn, self.getOutputPath('crop.mrc'), box,
+                            slabBytes=1024)
+        crop, voxelSize = self._readVolume(cropFn)
+        self.assertEqual(voxelSize, 1.5)
+        np.testing.assert_array_equal(crop, data[inside])
+
+        pasteFn = pasteVolume(cropFn, self.getOutputPath('paste.mrc'),
+                              shape, box, slabBytes=1024)
+        pasted, voxelSize = self._readVolume(pasteFn)
+        self.assertEqual(voxelSize, 1.5)
+        expected = np.zeros_like(data)
+        expected[inside] = data[inside]
+        np.testing.assert_array_equal(pasted, expected)
+
+        # The taper only fades the faces of the box inside the volume
+        taper = 3
+        pasteFn = pasteVolume(cropFn, self.getOutputPath('taper.mrc'),
+                              shape, box, taper=taper)
+        pasted, _ = self._readVolume(pasteFn)
+        core = tuple(slice(start + taper, end - taper) for start, end in box)
+        np.testing.assert_array_equal(pasted[core], data[core])
+        (z0, _), (y0, _), (x0, _) = box
+        self.assertLess(abs(pasted[z0, y0 + 5, x0 + 5]),
+                        abs(data[z0, y0 + 5, x0 + 5]))
+
+    def test_fast_size_padding(self):
+        self.assertEqual([getFastSize(n) for n in [33, 450, 462]],
+                         [36, 450, 480])
+        self.assertFalse(isFastSize(33))
+
+        # A non-fast box is padded to a fast size and cropped back
+        shape = (33, 33, 33)
+        data = np.random.default_rng(0).normal(size=shape).astype(np.float32)
+        volFn = self._writeVolume('odd.mrc', data)
+        box = [(0, n) for n in shape]
+        self.assertTrue(isFullBox(box, shape))
+        padShape = getPadShape(box)
+        self.assertEqual(padShape, (36, 36, 36))
+
+        padFn = cropVolume(volFn, self.getOutputPath('odd_pad.mrc'), box,
+                           padShape=padShape)
+        padded, _ = self._readVolume(padFn)
+        self.assertEqual(padded.shape, padShape)
+        center = padded[1:34, 1:34, 1:34]
+        np.testing.assert_array_equal(center, data)
+        self.assertEqual(np.abs(padded).sum(), np.abs(center).sum())
+
+        outFn = pasteVolume(padFn, self.getOutputPath('odd_out.mrc'),
+                            shape, box)
+        restored, voxelSize = self._readVolume(outFn)
+        self.assertEqual(voxelSize, 1.5)
+        np.testing.assert_array_equal(restored, data)
+
+    def test_composite_locres(self):
+        shape = (8, 8, 8)
+        boxes = [[(0, 8), (0, 8), (0, 5)], [(0, 8), (0, 8), (3, 8)]]
+        values, weights = [8, 4], [0.25, 1]
+        cropFns, weightFns = [], []
+        for i, box in enumerate(boxes):
+            cropShape = tuple(end - start for start, end in box)
+            cropFns.append(self._writeVolume(
+                'body%d.mrc' % i,
+                np.full(cropShape, values[i], dtype=np.float32)))
+            weightFns.append(self._writeVolume(
+                'body%d_mask.mrc' % i,
+                np.full(cropShape, weights[i], dtype=np.float32)))
+
+        outFn = compositeVolumes(cropFns, weightFns,
+                                 self.getOutputPath('composite.mrc'),
+                                 shape, boxes)
+        faded, _ = self._readVolume(outFn)
+        self.assertAlmostEqual(faded[0, 0, 0], 2)
+
+        # Local resolution keeps the value of each body at soft edges
+        outFn = compositeVolumes(cropFns, weightFns,
+                                 self.getOutputPath('composite_locres.mrc'),
+                                 shape, boxes, fade=False)
+        locres, _ = self._readVolume(outFn)
+        np.testing.assert_allclose(locres[..., :3], 8)
+        np.testing.assert_allclose(locres[..., 3:5], (8 * 0.25 + 4) / 1.25)
+        np.testing.assert_allclose(locres[..., 5:], 4)
@@ -0,0 +1,133 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..cache import ConversionCache, makeStampKey
+from ..engine import writeVolume
+
+
+class TestSideSplitterCache(BaseTest):
+    """ Reuse of converted and filtered maps between runs, no input
+    data needed.
+    """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeVolume(self, fn, data):
+        with mrcfile.new(fn, data, overwrite=True) as mrc:
+            mrc.voxel_size = 1.0
+        return fn
+
+    def _runFilter(self, cache, runDir, inputFns, **params):
+        """ Mimic a run of the protocol: outputs are reused if their
+        fingerprint is cached, otherwise computed and stored.
+        Return True if the cache was used.
+        """
+        os.makedirs(runDir, exist_ok=True)
+        fingerprint = cache.makeKey(inputFns, **params)[:16]
+        outputs = [('%s_half%d' % (fingerprint, i),
+                    os.path.join(runDir, 'half%d.mrc' % i)) for i in [1, 2]]
+        if all(cache.fetch(key, fn) for key, fn in outputs):
+            return True
+        for (key, fn), inFn in zip(outputs, inputFns):
+            with mrcfile.open(inFn, permissive=True) as mrc:
+                self._writeVolume(fn, mrc.data * 2)
+            cache.store(key, fn)
+        return False
+
+    def test_reuse(self):
+        cache = ConversionCache(self.getOutputPath('cache'), 10 * 1024 ** 2)
+        rng = np.random.default_rng(0)
+        os.makedirs(self.getOutputPath('in'))
+        inputFns = [self._writeVolume(self.getOutputPath('in', 'h%d.mrc' % i),
+                                      rng.normal(size=(16, 16, 16))
+                                      .astype(np.float32)) for i in [1, 2]]
+
+        run1 = self.getOutputPath('run1')
+        self.assertFalse(self._runFilter(cache, run1, inputFns, snr=True))
+
+        # Copies of the inputs have the same content and fingerprint
+        os.makedirs(self.getOutputPath('copy'))
+        copyFns = []
+        for fn in inputFns:
+            copyFn = self.getOutputPath('copy', os.path.basename(fn))
+            shutil.copyfile(fn, copyFn)
+            copyFns.append(copyFn)
+        self.assertNotEqual(makeStampKey(inputFns), makeStampKey(copyFns))
+
+        run2 = self.getOutputPath('run2')
+        self.assertTrue(self._runFilter(cache, run2, copyFns, snr=True))
+        for name in ['half1.mrc', 'half2.mrc']:
+            fn1, fn2 = os.path.join(run1, name), os.path.join(run2, name)
+            # Outputs are hard links to the same cached file
+            self.assertTrue(os.path.samefile(fn1, fn2))
+
+        # Other parameters get another fingerprint
+        run3 = self.getOutputPath('run3')
+        self.assertFalse(self._runFilter(cache, run3, inputFns, snr=False))
+        self.assertFalse(os.path.samefile(os.path.join(run1, 'half1.mrc'),
+                                          os.path.join(run3, 'half1.mrc')))
+
+    def test_evict(self):
+        data = np.zeros((32, 32, 32), dtype=np.float32)
+        os.makedirs(self.getOutputPath('evict'))
+        fn = self._writeVolume(self.getOutputPath('evict', 'vol.mrc'), data)
+        size = os.path.getsize(fn)
+        cache = ConversionCache(self.getOutputPath('evict_cache'),
+                                int(2.5 * size))
+        for key in ['a', 'b', 'c']:
+            cache.store(key, fn)
+        # The least recently used entry is removed
+        self.assertEqual([cache.has(k) for k in 'abc'], [False, True, True])
+        outFn = self.getOutputPath('evict', 'out.mrc')
+        self.assertFalse(cache.fetch('a', outFn))
+        self.assertTrue(cache.fetch('b', outFn))
+        # Evicted entries do not break the runs linked to them
+        self.assertTrue(os.path.exists(fn))
+
+    def test_rewrite_output(self):
+        cache = ConversionCache(self.getOutputPath('rewrite_cache'),
+                                10 * 1024 ** 2)
+        os.makedirs(self.getOutputPath('rewrite'))
+        fn = self.getOutputPath('rewrite', 'half1.mrc')
+        old = np.ones((16, 16, 16), dtype=np.float32)
+        writeVolume(fn, old, 1.0)
+        cache.store('old', fn)
+
+        # A new filtered map written at the same path leaves the entry
+        writeVolume(fn, 2 * old, 1.0)
+        outFn = self.getOutputPath('rewrite', 'fetched.mrc')
+        self.assertTrue(cache.fetch('old', outFn))
+        with mrcfile.open(outFn, permissive=True) as mrc:
+            np.testing.assert_array_equal(mrc.data, old)
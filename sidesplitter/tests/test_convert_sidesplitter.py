@@ -0,0 +1,63 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..convert import (STAGE_LINK, stageHalfMap, convertVolumeSlabs,
+                       prepareMask, binVolume, combineHalves)
+
+
+class TestSideSplitterConvert(BaseTest):
+    """ Staging of the inputs, no input data needed. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_linked_input_kept(self):
+        data = np.random.default_rng(0).random((32, 32, 32),
+                                               dtype=np.float32)
+        inFn = self.getOutputPath('input_half1.mrc')
+        with mrcfile.new(inFn, data, overwrite=True) as mrc:
+            mrc.voxel_size = 1.0
+        outFn = self.getOutputPath('half1_unfil.mrc')
+
+        # Writers replace the staged link instead of writing the input
+        writers = [lambda: binVolume(outFn, outFn, 2),
+                   lambda: prepareMask(outFn, outFn),
+                   lambda: convertVolumeSlabs(outFn, outFn, mode=12),
+                   lambda: combineHalves(outFn, outFn, outFn)]
+        for write in writers:
+            self.assertEqual(stageHalfMap(inFn, outFn), STAGE_LINK)
+            self.assertTrue(os.path.samefile(inFn, outFn))
+            write()
+            self.assertFalse(os.path.samefile(inFn, outFn))
+            with mrcfile.open(inFn, permissive=True) as mrc:
+                np.testing.assert_array_equal(mrc.data, data)
@@ -0,0 +1,70 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest
+
+from ..benchmark import makeHalfMaps
+from ..engine import LocalFilter, filterTiled
+
+
+class TestSideSplitterEngine(BaseTest):
+    """ Tiled execution of the native filter, no input data needed. """
+    @classmethod
+    def setUpClass(cls):
+        cls.signal, cls.half1, cls.half2, cls.mask = makeHalfMaps(48)
+        localFilter = LocalFilter(cls.half1.shape)
+        cls.whole = localFilter.filter(cls.half1, cls.half2, cls.mask,
+                                       locres=True)
+
+    def _filterTiled(self, tileSize, processes=1):
+        return filterTiled(self.half1, self.half2, self.mask,
+                           tileSize=tileSize, pad=16, processes=processes,
+                           locres=True)
+
+    def test_single_tile(self):
+        # A single tile covers the whole volume without blending
+        for whole, tiled in zip(self.whole, self._filterTiled(48)):
+            np.testing.assert_array_equal(tiled, whole)
+
+    def test_tiled_agreement(self):
+        tiled = self._filterTiled(24)
+        inside = self.mask > 0.5
+        for whole, out in zip(self.whole[:2], tiled[:2]):
+            corr = np.corrcoef(whole[inside], out[inside])[0, 1]
+            self.assertGreater(corr, 0.9)
+            # Tiles do not lose signal compared to the whole volume
+            self.assertGreater(
+                np.corrcoef(self.signal.ravel(), out.ravel())[0, 1],
+                0.95 * np.corrcoef(self.signal.ravel(), whole.ravel())[0, 1])
+        corr = np.corrcoef(self.whole[2][inside], tiled[2][inside])[0, 1]
+        self.assertGreater(corr, 0.7)
+
+        # The pool only changes the order in which tiles are accumulated
+        pooled = self._filterTiled(24, processes=2)
+        for out, outPool in zip(tiled, pooled):
+            np.testing.assert_allclose(outPool, out, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,63 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..benchmark import makeHalfMaps
+from ..fsc import computeFsc
+
+
+class TestSideSplitterFsc(BaseTest):
+    """ FSC of memory-mapped half-maps, no input data needed. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        _, half1, half2, mask = makeHalfMaps(32)
+        cls.fns = []
+        for name, data in [('half1', half1), ('half2', half2),
+                           ('mask', mask)]:
+            fn = cls.getOutputPath(name + '.mrc')
+            # Staged maps may have no voxel size in the header
+            with mrcfile.new(fn, data, overwrite=True) as mrc:
+                mrc.voxel_size = 0
+            cls.fns.append(fn)
+
+    def test_voxel_size(self):
+        with self.assertRaises(ValueError):
+            computeFsc(*self.fns)
+
+        freqs, fsc, maskedFsc = computeFsc(*self.fns, voxelSize=2.0)
+        self.assertAlmostEqual(freqs[-1], 0.25)
+        self.assertTrue(np.all(np.isfinite(fsc)))
+        self.assertAlmostEqual(fsc[0], 1, places=3)
+        # Small slabs give the same curves
+        _, fscSlabs, maskedSlabs = computeFsc(*self.fns, voxelSize=2.0,
+                                              slabBytes=4096)
+        np.testing.assert_allclose(fscSlabs, fsc, atol=1e-5)
+        np.testing.assert_allclose(maskedSlabs, maskedFsc, atol=1e-5)
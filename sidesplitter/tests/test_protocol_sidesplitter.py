@@ -25,14 +25,24 @@
 # **************************************************************************
 
 import os
+import time
+
+import numpy as np
 
 from pyworkflow.utils import magentaStr, makePath, copyFile
 from pyworkflow.tests import BaseTest, DataSet, setupTestProject
 from pyworkflow.plugin import Domain
+from pyworkflow.object import Set
+from pyworkflow.protocol import getUpdatedProtocol
+from pyworkflow.protocol.constants import STATUS_RUNNING, STATUS_FINISHED
 from pwem.objects import Volume
+from pwem.emlib.image import ImageHandler
 from pwem.protocols import ProtImportParticles, ProtImportVolumes
 
-from ..protocols import ProtSideSplitter
+from ..protocols import (ProtSideSplitter, ProtSideSplitterBatch,
+                         ProtSideSplitterStreaming)
+from ..constants import ENGINE_BINARY, ENGINE_NATIVE, BIN_2X
+from ..convert import getVolumeStats
 
 
 try:
@@ -80,8 +90,6 @@ class TestSideSplitter(BaseTest):
         return protPart
 
     def _createRef3DProtBox(self, label, protocol):
-        from pyworkflow.protocol.constants import STATUS_FINISHED
-
         prot = self.newProtocol(protocol)
         self.saveProtocol(prot)
 
@@ -123,7 +131,14 @@ class TestSideSplitter(BaseTest):
                                msg="Pixel size of your volume is %0.2f and"
                                    " must be %0.2f" % (sr, pxSize))
 
-    def test_sidesplitter(self):
+        stats = getVolumeStats(vol)
+        self.assertIsNotNone(stats, "Output volume has no statistics")
+        self.assertEqual(stats['dims'], (dims,) * 3)
+        self.assertLessEqual(stats['min'], stats['mean'])
+        self.assertLessEqual(stats['mean'], stats['max'])
+        self.assertTrue(os.path.exists(stats['preview']))
+
+    def _prepareRefinement(self):
         protRef, protMask = self._createRef3DProtBox("auto-refine",
                                                      ProtRelionRefine3D)
         protRef._createFilenameTemplates()
@@ -140,6 +155,11 @@ class TestSideSplitter(BaseTest):
         project = protRef.getProject()
         project._storeProtocol(protRef)
 
+        return protRef, protMask
+
+    def test_sidesplitter(self):
+        protRef, protMask = self._prepareRefinement()
+
         print(magentaStr("\n==> Testing sidesplitter - after refine 3d:"))
         sidesplitterProt = self.newProtocol(ProtSideSplitter,
                                             protRefine=protRef,
@@ -148,3 +168,172 @@ class TestSideSplitter(BaseTest):
 
         self.launchProtocol(sidesplitterProt)
         self._validations(sidesplitterProt.outputVolume1, 60, 3)
+        # Input and filtered FSC, with and without mask
+        self.assertEqual(sidesplitterProt.outputFSCs.getSize(), 4)
+
+    def test_sidesplitter_preview(self):
+        protRef, protMask = self._prepareRefinement()
+
+        print(magentaStr("\n==> Testing sidesplitter - preview binned 2x:"))
+        previewProt = self.newProtocol(ProtSideSplitter,
+                                       protRefine=protRef,
+                                       mask=protMask.outputMask,
+                                       previewBinning=BIN_2X)
+        previewProt.setObjLabel('sidesplitter preview')
+
+        self.launchProtocol(previewProt)
+        self._validations(previewProt.outputVolume1, 30, 6)
+        self._validations(previewProt.outputVolume2, 30, 6)
+
+    def test_sidesplitter_batch(self):
+        protRef, protMask = self._prepareRefinement()
+
+        print(magentaStr("\n==> Testing sidesplitter batch - after refine 3d:"))
+        batchProt = self.newProtocol(ProtSideSplitterBatch,
+                                     numberOfThreads=3)
+        batchProt.inputProtocols.append(protRef)
+        batchProt.inputProtocols.append(protRef)
+        batchProt.inputMasks.append(protMask.outputMask)
+        batchProt.setObjLabel('sidesplitter batch')
+
+        self.launchProtocol(batchProt)
+        self.assertEqual(batchProt.outputVolumes1.getSize(), 2)
+        self.assertEqual(batchProt.outputVolumes2.getSize(), 2)
+        for vol in batchProt.outputVolumes1:
+            self._validations(vol, 60, 3)
+
+    def test_sidesplitter_streaming(self):
+        protRef, protMask = self._prepareRefinement()
+        # The refinement is still running while the half-maps appear
+        protRef.setStatus(STATUS_RUNNING)
+        self.proj._storeProtocol(protRef)
+
+        print(magentaStr("\n==> Testing sidesplitter streaming:"))
+        prot = self.newProtocol(ProtSideSplitterStreaming,
+                                protRefine=protRef,
+                                mask=protMask.outputMask,
+                                fileDelay=0,
+                                maxJobs=1)
+        prot.setObjLabel('sidesplitter streaming')
+        self.proj.launchProtocol(prot, wait=False)
+
+        def writeHalves(name):
+            for half, fn in [('half1', self.half1Fn), ('half2', self.half2Fn)]:
+                copyFile(fn, protRef._getExtraPath(name % half))
+
+        writeHalves('run_it001_%s_class001.mrc')
+        time.sleep(45)
+        # Written while the first pair may still be filtering, the final
+        # maps must not be skipped
+        writeHalves('run_it002_%s_class001.mrc')
+        writeHalves('run_%s_class001_unfil.mrc')
+        protRef.setStatus(STATUS_FINISHED)
+        self.proj._storeProtocol(protRef)
+
+        for _ in range(60):
+            prot = getUpdatedProtocol(prot)
+            if not prot.isActive():
+                break
+            time.sleep(10)
+        self.assertTrue(prot.isFinished(), "Streaming protocol did not "
+                                           "finish")
+
+        outSet = prot.outputVolumes1
+        self.assertEqual(outSet.getStreamState(), Set.STREAM_CLOSED)
+        keys = sorted(os.path.basename(os.path.dirname(vol.getFileName()))
+                      for vol in outSet)
+        self.assertIn('run_it001_half1_class001', keys)
+        self.assertIn('run_half1_class001_unfil', keys)
+        for vol in prot.outputVolumes2:
+            self._validations(vol, 60, 3)
+
+    def test_native_engine(self):
+        """ The native engine must give maps close to the binary ones. """
+        protRef, protMask = self._prepareRefinement()
+        prots = {}
+        for engine, label in [(ENGINE_BINARY, 'binary'),
+                              (ENGINE_NATIVE, 'native')]:
+            print(magentaStr("\n==> Testing sidesplitter - %s engine:" % label))
+            prot = self.newProtocol(ProtSideSplitter,
+                                    protRefine=protRef,
+                                    mask=protMask.outputMask,
+                                    engine=engine)
+            prot.setObjLabel('sidesplitter %s engine' % label)
+            self.launchProtocol(prot)
+            self._validations(prot.outputVolume1, 60, 3)
+            prots[engine] = prot
+
+        ih = ImageHandler()
+        for output in ['outputVolume1', 'outputVolume2']:
+            data = [ih.read(getattr(prots[e], output)).getData().ravel()
+                    for e in [ENGINE_BINARY, ENGINE_NATIVE]]
+            cc = np.corrcoef(data[0], data[1])[0, 1]
+            self.assertGreater(cc, 0.9, "Correlation between binary and "
+                                        "native %s is %0.3f" % (output, cc))
+
+    def test_local_resolution(self):
+        protRef, protMask = self._prepareRefinement()
+
+        print(magentaStr("\n==> Testing sidesplitter - local resolution:"))
+        prot = self.newProtocol(ProtSideSplitter,
+                                protRefine=protRef,
+                                mask=protMask.outputMask,
+                                engine=ENGINE_NATIVE,
+                                doLocalResolution=True)
+        prot.setObjLabel('sidesplitter local resolution')
+        self.launchProtocol(prot)
+
+        self._validations(prot.outputLocalResolution, 60, 3)
+        stats = getVolumeStats(prot.outputLocalResolution)
+        # Never better than Nyquist
+        self.assertGreaterEqual(stats['min'], 2 * 3 - 0.01)
+
+    def test_combined(self):
+        protRef, protMask = self._prepareRefinement()
+
+        print(magentaStr("\n==> Testing sidesplitter - combined map:"))
+        prot = self.newProtocol(ProtSideSplitter,
+                                protRefine=protRef,
+                                mask=protMask.outputMask,
+                                doCombine=True,
+                                bfactor=-50)
+        prot.setObjLabel('sidesplitter combined')
+        self.launchProtocol(prot)
+
+        self._validations(prot.outputVolume, 60, 3)
+        self.assertEqual(len(prot.outputVolume.getHalfMaps().split(',')), 2)
+
+    def test_multibody(self):
+        protRef, protMask = self._prepareRefinement()
+
+        # Split the mask in two overlapping bodies along Z
+        ih = ImageHandler()
+        maskImg = ih.read(protMask.outputMask.getFileName())
+        maskData = maskImg.getData()
+        bodiesPath = self.proj.getTmpPath('bodies')
+        makePath(bodiesPath)
+        for i, (start, end) in enumerate([(0, 34), (26, 60)]):
+            body = np.zeros_like(maskData)
+            body[start:end] = maskData[start:end]
+            maskImg.setData(body)
+            maskImg.write(os.path.join(bodiesPath, 'body%d.mrc' % (i + 1)))
+
+        print(magentaStr("\n==> Importing data - body masks:"))
+        protBodies = self.newProtocol(ProtImportVolumes,
+                                      objLabel='import body masks',
+                                      filesPath=bodiesPath,
+                                      filesPattern='body*.mrc',
+                                      samplingRate=3)
+        self.launchProtocol(protBodies)
+
+        print(magentaStr("\n==> Testing sidesplitter - multi-body:"))
+        prot = self.newProtocol(ProtSideSplitter,
+                                protRefine=protRef,
+                                bodyMasks=protBodies.outputVolumes,
+                                engine=ENGINE_NATIVE,
+                                numberOfThreads=3)
+        prot.setObjLabel('sidesplitter multi-body')
+        self.launchProtocol(prot)
+
+        self._validations(prot.outputVolume1, 60, 3)
+        self._validations(prot.outputVolume2, 60, 3)
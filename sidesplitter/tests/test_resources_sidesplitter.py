@@ -0,0 +1,95 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import time
+import threading
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest
+
+from ..constants import ENGINE_BINARY, ENGINE_NATIVE
+from ..resources import (estimateFilter, volumeBytes, MASK_VOLUMES,
+                         LOCRES_VOLUMES, StepMonitor, getTotalWall)
+
+
+class TestSideSplitterResources(BaseTest):
+    """ Memory model and resource monitoring, no input data needed. """
+
+    def test_estimate_filter(self):
+        dims = (64, 64, 64)
+        vol = volumeBytes(dims)
+        for engine in [ENGINE_BINARY, ENGINE_NATIVE]:
+            base = estimateFilter(dims, engine, useMask=True)
+            locres = estimateFilter(dims, engine, useMask=True, locres=True)
+            # Only the native engine writes the local resolution map
+            extra = LOCRES_VOLUMES * vol if engine == ENGINE_NATIVE else 0
+            self.assertEqual(locres - base, extra)
+            self.assertEqual(base - estimateFilter(dims, engine),
+                             MASK_VOLUMES * vol)
+
+        tiled = estimateFilter(dims, ENGINE_NATIVE, threads=2, tileSize=32,
+                               tilePadding=8, locres=True)
+        self.assertGreater(tiled, 0)
+
+    def test_step_monitor_threads(self):
+        stats = {}
+
+        def busy():
+            with StepMonitor() as monitor:
+                end = time.time() + 1
+                while time.time() < end:
+                    pass
+            stats['busy'] = monitor.stats
+
+        def idle():
+            with StepMonitor() as monitor:
+                time.sleep(1)
+            stats['idle'] = monitor.stats
+
+        threads = [threading.Thread(target=f) for f in [busy, idle]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Each step only gets the CPU time of its own thread
+        self.assertGreater(stats['busy']['cpu'], 0.5)
+        self.assertLess(stats['idle']['cpu'], 0.2)
+        # Overlapping steps are not added up
+        self.assertLess(getTotalWall(stats), 1.5)
+
+    def test_step_monitor_peak(self):
+        size = 400 * 1024 ** 2
+        with StepMonitor() as big:
+            data = np.ones(size // 8)
+            del data
+        with StepMonitor() as empty:
+            pass
+
+        # The peak is the one of each step, not of the process lifetime
+        self.assertGreater(big.stats['peak'], size)
+        self.assertLess(empty.stats['peak'], big.stats['peak'] - size / 2)
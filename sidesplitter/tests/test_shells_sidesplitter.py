@@ -0,0 +1,83 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+from unittest import mock
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from ..shells import (SHELLS_DIR_ENV, getShells, _getShells, _computeRadius,
+                      _indexDtype)
+
+
+class TestSideSplitterShells(BaseTest):
+    """ Shells of the rfft half-space, no input data needed. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def setUp(self):
+        _getShells.cache_clear()
+
+    def _assertReadOnly(self, data):
+        self.assertFalse(data.flags.writeable)
+        with self.assertRaises(ValueError):
+            data[0, 0, 0] = 1
+
+    def test_saved_shells(self):
+        shape = (20, 24, 18)
+        shellsDir = self.getOutputPath('shells')
+        radius, index = getShells(shape, shellsDir)
+        np.testing.assert_array_equal(radius, _computeRadius(shape))
+        np.testing.assert_array_equal(index, np.rint(radius))
+        self.assertEqual(radius.shape, (20, 24, 10))
+        self.assertEqual(index.dtype, np.int16)
+        for data in (radius, index):
+            self._assertReadOnly(data)
+        self.assertEqual(len(os.listdir(shellsDir)), 2)
+
+        # A new process memory-maps the saved files
+        _getShells.cache_clear()
+        with mock.patch.dict(os.environ, {SHELLS_DIR_ENV: shellsDir}):
+            loaded = getShells(list(shape))
+        for data, saved in zip((radius, index), loaded):
+            self.assertIsInstance(saved, np.memmap)
+            self.assertEqual(saved.dtype, data.dtype)
+            np.testing.assert_array_equal(saved, data)
+            self._assertReadOnly(saved)
+
+    def test_index_dtype(self):
+        self.assertEqual(_indexDtype(np.array([32766.])), np.int16)
+        self.assertEqual(_indexDtype(np.array([32767.])), np.int32)
+
+        # Nothing is saved without a folder
+        with mock.patch.dict(os.environ):
+            os.environ.pop(SHELLS_DIR_ENV, None)
+            radius, index = getShells((8, 8, 8))
+        self.assertNotIsInstance(radius, np.memmap)
+        self._assertReadOnly(index)
@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import pyworkflow.protocol.params as params
+from pyworkflow.viewer import DESKTOP_TKINTER, WEB_DJANGO, ProtocolViewer
+from pwem.viewers import DataView
+
+from .constants import BIN_NONE
+from .protocols import ProtSideSplitter
+
+
+class SideSplitterViewer(ProtocolViewer):
+    """ Display the filtered half-maps and, for preview runs, launch
+    the same run on the full-size half-maps. The batch and streaming
+    protocols have sets of half-maps and no preview.
+    """
+    _label = 'viewer local filter'
+    _targets = [ProtSideSplitter]
+    _environments = [DESKTOP_TKINTER, WEB_DJANGO]
+
+    def _defineParams(self, form):
+        form.addSection(label='Visualization')
+        form.addParam('displayVolumes', params.LabelParam,
+                      label='Display filtered half-maps')
+        form.addParam('launchFullRun', params.LabelParam,
+                      label='Launch the full-size run',
+                      help='Copy this preview run with no binning and '
+                           'launch it.')
+
+    def _getVisualizeDict(self):
+        return {'displayVolumes': self._showVolumes,
+                'launchFullRun': self._launchFullRun}
+
+    def _showVolumes(self, paramName=None):
+        return [DataView(getattr(self.protocol, name).getFileName())
+                for half in [1, 2]
+                for name in ['outputVolume%d' % half, 'outputVolumes%d' % half]
+                if hasattr(self.protocol, name)]
+
+    def _launchFullRun(self, paramName=None):
+        if not hasattr(self.protocol, 'previewBinning'):
+            return [self.errorMessage("Only local filter runs can be "
+                                      "previews.")]
+        if not self.protocol._isPreview():
+            return [self.errorMessage("This run already uses the "
+                                      "full-size half-maps.")]
+
+        project = self.getProject()
+        prot = project.copyProtocol(self.protocol)
+        prot.previewBinning.set(BIN_NONE)
+        prot.setObjLabel('%s (full size)' % (self.protocol.getObjLabel() or
+                                             ProtSideSplitter._label))
+        project.launchProtocol(prot)
+
+        return [self.infoMessage("Launched %s." % prot.getRunName())]